@@ -0,0 +1,87 @@
+import copy, time, json, argparse
+import torch
+import nltk
+import evaluate
+from transformers import AutoTokenizer
+from model import GraphEncoder
+from generate import load_model, iter_generated_batches
+from precision import PrecisionPolicy
+from quantization import quantize_model, quantize_graph_encoder
+from utils import iter_articles, load_train_config, get_tokenized_elife_data, get_elife_dataloader
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_dir", help="directory of the trained model (results are written there)")
+    parser.add_argument("--num_articles", type=int, default=32, help="number of test articles to compare on")
+    parser.add_argument("--num_threads", type=int, default=None, help="intra-op threads used for generation")
+    return parser.parse_args()
+
+
+def generate_summaries(model, tokenizer, graph_encoder, dataloader):
+    """
+    Generate summaries for every batch of the dataloader on CPU, returning them by article index and the time taken.
+    """
+    preds = {}
+    start = time.perf_counter()
+    generated_batches = iter_generated_batches(model, tokenizer, graph_encoder, dataloader, [{}], "cpu", PrecisionPolicy("cpu"))
+    for idxs, (decoded_preds,) in generated_batches:
+        preds.update(zip(idxs, decoded_preds))
+    return preds, time.perf_counter() - start
+
+
+def compute_rouge(metric, preds, refs):
+    # rougeLSum expects newline after each sentence
+    preds = ["\n".join(nltk.sent_tokenize(pred.strip())) for pred in preds]
+    refs = ["\n".join(nltk.sent_tokenize(ref.strip())) for ref in refs]
+    result = metric.compute(predictions=preds, references=refs, use_stemmer=True)
+    return {k: round(v * 100, 4) for k, v in result.items()}
+
+
+def main():
+    args = parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    config = load_train_config(args.model_dir)
+    config['batch_size'] = 4
+
+    # held-out slice: the first articles of the test split
+    ds = "elife"
+    tokenizer = AutoTokenizer.from_pretrained(args.model_dir)
+    test_data = get_tokenized_elife_data(ds, tokenizer, config, "test")
+    test_data = test_data.select(range(min(args.num_articles, len(test_data))))
+    idxs = test_data["idx"]
+    dataloader = get_elife_dataloader(test_data, tokenizer, config, shuffle=False)
+
+    summaries = [inst['summary'] for inst in iter_articles(ds, "test", columns=("summary",))]
+    refs = [summaries[i] for i in idxs]
+
+    model = load_model(args.model_dir, config, "cpu", torch.float32)
+    graph_encoder = GraphEncoder(config)
+    metric = evaluate.load("rouge")
+
+    results = {"num_articles": len(idxs), "num_threads": torch.get_num_threads()}
+
+    fp32_preds, results["fp32_seconds"] = generate_summaries(model, tokenizer, graph_encoder, dataloader)
+    results["fp32_rouge"] = compute_rouge(metric, [fp32_preds[i] for i in idxs], refs)
+
+    # quantised copies, the float32 model and GAT are kept as they are
+    int8_model = quantize_model(model)
+    int8_graph_encoder = quantize_graph_encoder(copy.copy(graph_encoder))
+
+    int8_preds, results["int8_seconds"] = generate_summaries(int8_model, tokenizer, int8_graph_encoder, dataloader)
+    results["int8_rouge"] = compute_rouge(metric, [int8_preds[i] for i in idxs], refs)
+
+    results["speedup"] = round(results["fp32_seconds"] / results["int8_seconds"], 3)
+    results["rouge_delta"] = {k: round(results["int8_rouge"][k] - v, 4) for k, v in results["fp32_rouge"].items()}
+    results["identical_summaries"] = sum(fp32_preds[i] == int8_preds[i] for i in idxs)
+
+    print(json.dumps(results, indent=2))
+    with open(f"{args.model_dir}/quantization_benchmark.json", "w") as f:
+        f.write(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+import os
+import sys
+import glob
+import json
+import time
+import pickle
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import torch
+
+from model import LEDKForConditionalGeneration
+from benchmarks.synthetic import (
+    make_synthetic_article, make_synthetic_graph, make_synthetic_tokenizer, make_tiny_led_config, make_graph_config,
+)
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# model variants of the paper, as config flags
+VARIANTS = {
+    "graph_decoder": {"is_graph_decoder": True, "is_merge_encoders": False, "is_input_aug": False},
+    "merge_encoders": {"is_graph_decoder": False, "is_merge_encoders": True, "is_input_aug": False},
+    "input_aug": {"is_graph_decoder": False, "is_merge_encoders": False, "is_input_aug": True},
+}
+
+# metrics compared against the baseline, and whether higher values are better
+COMPARED_METRICS = {
+    "train_steps_per_second": True,
+    "summaries_per_second": True,
+    "train_peak_rss_mb": False,
+    "generate_peak_rss_mb": False,
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--variants", nargs="+", default=list(VARIANTS), choices=list(VARIANTS))
+    parser.add_argument("--num_articles", type=int, nargs=3, default=[32, 4, 8], metavar=("TRAIN", "VAL", "TEST"),
+                        help="synthetic articles per split")
+    parser.add_argument("--num_epochs", type=int, default=1)
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--num_nodes", type=int, default=128, help="nodes per synthetic graph")
+    parser.add_argument("--num_edges", type=int, default=512, help="edges per synthetic graph")
+    parser.add_argument("--d_model", type=int, default=64)
+    parser.add_argument("--num_threads", type=int, default=None, help="threads of the train/generate processes")
+    parser.add_argument("--work_dir", default=None, help="directory for the synthetic data and models (default: temporary)")
+    parser.add_argument("--output", default="benchmarks/end_to_end_results.json", help="JSON file the results are written to")
+    parser.add_argument("--baseline", default=None, help="results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="relative throughput decrease (or memory increase) over the baseline reported as a regression")
+    return parser.parse_args()
+
+
+def write_synthetic_data(args, work_dir):
+    """
+    Synthetic eLife splits (`{data_root}/elife/{split}.json`), graph pickles and graph text files in the current
+    formats, and a tiny randomly initialised model with a tokenizer trained on the synthetic text.
+    """
+    data_root, graph_data_path, init_dir = f"{work_dir}/data", f"{work_dir}/graph_data", f"{work_dir}/init_model"
+    for path in [f"{data_root}/elife", graph_data_path]:
+        os.makedirs(path, exist_ok=True)
+
+    texts = []
+    for split, num_articles in zip(["train", "val", "test"], args.num_articles):
+        seed = {"train": 0, "val": 100000, "test": 200000}[split]
+        articles = [make_synthetic_article(f"{split}{i}", seed=seed + i) for i in range(num_articles)]
+        graphs = [make_synthetic_graph(a['id'], args.num_nodes, args.num_edges, seed=seed + i) for i, a in enumerate(articles)]
+
+        with open(f"{data_root}/elife/{split}.json", "w") as f:
+            f.write(json.dumps(articles))
+        with open(f"{graph_data_path}/{split}_graphs_with_features.pkl", "wb") as f:
+            pickle.dump(graphs, f)
+        # graph "explanations" prepended to the article text by the input augmentation variant
+        with open(f"{graph_data_path}/{split}_abstract_concepts_explanation.jsonl", "w") as f:
+            for a in articles:
+                f.write(json.dumps({"id": a['id'], "text": " ".join(a['summary'][:2])})+"\n")
+
+        for a in articles:
+            texts.extend(a['abstract'] + [s for section in a['sections'] for s in section] + a['summary'])
+
+    config = make_tiny_led_config(d_model=args.d_model)
+    tokenizer = make_synthetic_tokenizer(texts, vocab_size=config.vocab_size)
+    torch.manual_seed(0)
+    LEDKForConditionalGeneration(config).save_pretrained(init_dir)
+    tokenizer.save_pretrained(init_dir)
+
+    return data_root, graph_data_path, init_dir
+
+
+def make_train_config(args, variant, work_dir, graph_data_path, init_dir):
+    config = {
+        "model_str": init_dir,
+        "encoder_max_length": 1024,
+        "decoder_max_length": 64,
+        "batch_size": args.batch_size,
+        "max_tokens_per_batch": None,
+        "pad_to_multiple_of": 64,
+        "num_workers": 0,
+        "pin_memory": False,
+        "tokenize_num_proc": 1,
+        "tokenized_cache_dir": f"{work_dir}/cache/tokenized",
+        **VARIANTS[variant],
+        "graph_attention_strategy": "full",
+        "precision": {"cpu": {"model": "fp32", "graph": "fp32", "autocast": None}},
+        "output_dir": f"{work_dir}/{variant}",
+        "lr": 1e-4,
+        "num_epochs": args.num_epochs,
+        "num_beams": 2,
+        "min_length": 8,
+        "length_penalty": 1.0,
+        "no_repeat_ngram_size": 3,
+        "profile_steps": None,
+        "rouge_num_workers": 0,
+        # checkpoints are selected on the validation loss, so that no ROUGE (and sentence splitting data) is needed
+        "validation": {"mode": "loss"},
+    }
+    config.update(make_graph_config(graph_data_path, d_model=args.d_model))
+    return config
+
+
+def run(cmd, env, log_path):
+    start = time.perf_counter()
+    with open(log_path, "w") as log_f:
+        process = subprocess.run(cmd, cwd=REPO_DIR, env=env, stdout=log_f, stderr=subprocess.STDOUT)
+    if process.returncode != 0:
+        with open(log_path, "r") as f:
+            print(f.read()[-5000:])
+        raise RuntimeError(f"{' '.join(cmd)} failed, see {log_path}")
+    return time.perf_counter() - start
+
+
+def read_metrics(path):
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f]
+
+
+def summarise_train_metrics(records):
+    steps = [r for r in records if "step" in r]
+    # the first step includes one-off setup (e.g. lazy initialisation), so it is left out of the rate if possible
+    timed = steps[1:] if len(steps) > 1 else steps
+    return {
+        "train_steps": len(steps),
+        "train_steps_per_second": round(len(timed) / sum(r['step_seconds'] for r in timed), 3),
+        "train_tokens_per_second": round(sum(r['tokens'] for r in timed) / sum(r['step_seconds'] for r in timed), 1),
+        "train_peak_rss_mb": max(r['peak_memory_mb'] for r in records),
+    }
+
+
+def summarise_generate_metrics(records):
+    return {
+        "summaries": sum(r['articles'] for r in records),
+        "summaries_per_second": round(sum(r['articles'] for r in records) / sum(r['step_seconds'] for r in records), 3),
+        "generate_peak_rss_mb": max(r['peak_memory_mb'] for r in records),
+    }
+
+
+def bench_variant(args, variant, work_dir, env, graph_data_path, init_dir):
+    """
+    Train a variant with `train.py` and generate summaries of the test split with `generate.py`, each in its own
+    process (so that peak RSS is measured per run), and summarise the metrics records they write.
+    """
+    config = make_train_config(args, variant, work_dir, graph_data_path, init_dir)
+    config_path = f"{work_dir}/{variant}_config.json"
+    with open(config_path, "w") as f:
+        f.write(json.dumps(config, indent=2))
+    # metrics and predictions are appended to, so a previous run in the same work_dir is removed
+    shutil.rmtree(config['output_dir'], ignore_errors=True)
+    os.makedirs(config['output_dir'])
+
+    result = {}
+    result["train_seconds"] = round(run([sys.executable, "train.py", config_path], env, f"{config['output_dir']}/train.log"), 2)
+    result.update(summarise_train_metrics(read_metrics(f"{config['output_dir']}/train_metrics.jsonl")))
+
+    # the last checkpoint saved is the best one
+    model_dir = max(glob.glob(f"{config['output_dir']}/elife_*"), key=os.path.getmtime)
+    result["generate_seconds"] = round(run([sys.executable, "generate.py", model_dir], env, f"{model_dir}/generate.log"), 2)
+    result.update(summarise_generate_metrics(read_metrics(f"{model_dir}/generate_metrics.jsonl")))
+
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """
+    Each compared metric relative to the baseline, and the metrics worse than it by more than `tolerance`.
+    """
+    comparison, regressions = {}, []
+    for variant, result in results.items():
+        if variant not in baseline:
+            continue
+        comparison[variant] = {}
+        for name, higher_is_better in COMPARED_METRICS.items():
+            ratio = result[name] / baseline[variant][name]
+            comparison[variant][name] = round(ratio, 3)
+            if (ratio < 1 - tolerance) if higher_is_better else (ratio > 1 + tolerance):
+                regressions.append(f"{variant}.{name}")
+    return comparison, regressions
+
+
+def main():
+    args = parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = os.path.abspath(args.work_dir or tmp_dir)
+        print(f"Writing synthetic data to {work_dir}...")
+        data_root, graph_data_path, init_dir = write_synthetic_data(args, work_dir)
+
+        # everything is local, so nothing should be downloaded
+        env = {**os.environ, "DATA_ROOT": data_root, "HF_DATASETS_OFFLINE": "1", "TRANSFORMERS_OFFLINE": "1",
+               "TOKENIZERS_PARALLELISM": "false"}
+        if args.num_threads is not None:
+            env["OMP_NUM_THREADS"] = str(args.num_threads)
+
+        results = {}
+        for variant in args.variants:
+            print(f"Benchmarking {variant}...")
+            results[variant] = bench_variant(args, variant, work_dir, env, graph_data_path, init_dir)
+            print(variant, results[variant])
+
+    output = {
+        "meta": {
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "num_threads": args.num_threads or torch.get_num_threads(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+
+    exit_code = 0
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline = json.loads(f.read())["results"]
+        comparison, regressions = compare(results, baseline, args.tolerance)
+        output["baseline_ratio"] = comparison
+        for variant, ratios in comparison.items():
+            for name, ratio in ratios.items():
+                flag = "  REGRESSION" if f"{variant}.{name}" in regressions else ""
+                print(f"{variant + '.' + name:50s} {ratio:>6.2f}x baseline{flag}")
+        if regressions:
+            print(f"{len(regressions)} metrics are more than {args.tolerance:.0%} worse than {args.baseline}")
+            exit_code = 1
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        f.write(json.dumps(output, indent=2))
+
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+import os
+import gc
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import numpy as np
+import torch
+import dgl
+from transformers.models.led.modeling_led import LEDEncoderBaseModelOutput, _expand_mask, _make_causal_mask
+
+from model import GraphEncoder, LEDKDecoderLayer, LEDKModel
+from graph_store import GraphStore
+from benchmarks.synthetic import make_synthetic_graphs, make_tiny_led_config, make_graph_config
+
+
+# (num_nodes, num_edges) of the synthetic graphs
+GRIDS = {
+    "small": [(64, 256), (256, 1024)],
+    "default": [(64, 256), (256, 1024), (1024, 4096), (4096, 16384)],
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--grid", default="default", choices=list(GRIDS), help="graph sizes to benchmark")
+    parser.add_argument("--batch_size", type=int, default=4, help="graphs (articles) per batch")
+    parser.add_argument("--num_relations", type=int, default=16, help="distinct relation ids in the synthetic graphs")
+    parser.add_argument("--text_length", type=int, default=1024, help="encoder length of the LEDK benchmarks")
+    parser.add_argument("--target_length", type=int, default=64, help="decoder length of the LEDK benchmarks")
+    parser.add_argument("--d_model", type=int, default=64)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--num_threads", type=int, default=None)
+    parser.add_argument("--output", default="benchmarks/results.json", help="JSON file the results are written to")
+    parser.add_argument("--baseline", default=None, help="results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="relative latency increase over the baseline reported as a regression")
+    return parser.parse_args()
+
+
+def read_proc_status(field):
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_memory():
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+        return torch.cuda.memory_allocated() / 2**20
+    # resets the peak resident set size (VmHWM) to the current one, if the kernel allows it
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return None
+    return read_proc_status("VmRSS")
+
+
+def peak_memory_increase(start):
+    if start is None:
+        return None
+    if torch.cuda.is_available():
+        return round(torch.cuda.max_memory_allocated() / 2**20 - start, 2)
+    peak = read_proc_status("VmHWM")
+    return round(peak - start, 2) if peak is not None else None
+
+
+def benchmark(fn, repeats, warmup, units=None):
+    """
+    Latency (ms) of `fn`, its throughput in `units` (a dict of unit name to count per call) and peak memory increase (MB).
+    """
+    with torch.no_grad():
+        for _ in range(warmup):
+            fn()
+
+        gc.collect()
+        memory_start = reset_peak_memory()
+        latencies = []
+        for _ in range(repeats):
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            fn()
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            latencies.append(time.perf_counter() - start)
+
+    median = float(np.median(latencies))
+    result = {
+        "latency_ms": round(median * 1000, 3),
+        "latency_ms_p90": round(float(np.percentile(latencies, 90)) * 1000, 3),
+        "peak_memory_mb": peak_memory_increase(memory_start),
+    }
+    for unit, count in (units or {}).items():
+        result[f"{unit}_per_second"] = round(count / median, 1)
+    return result
+
+
+def bench_graph_path(args, num_nodes, num_edges, graph_data_path):
+    graphs = make_synthetic_graphs(args.batch_size, num_nodes, num_edges, args.num_relations)
+    graph_encoder = GraphEncoder(make_graph_config(graph_data_path, d_model=args.d_model))
+    graph_encoder.GM.eval()
+    graph_encoder.stores["bench"] = GraphStore.from_graphs(graphs)
+    idxs = list(range(len(graphs)))
+
+    total_nodes = sum(len(g['nodes']) for g in graphs)
+    total_edges = sum(len(g['edges']) for g in graphs)
+
+    results = {}
+    results["graph_encoder.get_graph"] = benchmark(
+        lambda: [graph_encoder.get_graph(g['nodes'], g['edges']) for g in graphs], args.repeats, args.warmup,
+        {"graphs": len(graphs), "edges": total_edges},
+    )
+    results["graph_encoder.forward"] = benchmark(
+        lambda: graph_encoder.forward(0, "bench", "cpu"), args.repeats, args.warmup,
+        {"nodes": len(graphs[0]['nodes'])},
+    )
+    results["graph_encoder.forward_batch"] = benchmark(
+        lambda: graph_encoder.forward_batch(idxs, "bench", "cpu"), args.repeats, args.warmup,
+        {"graphs": len(graphs), "nodes": total_nodes},
+    )
+
+    # GAT alone, on an already batched graph
+    G, init_embeddings = build_gat_inputs(graph_encoder, idxs)
+    results["gat_model"] = benchmark(
+        lambda: graph_encoder.GM(G, init_embeddings), args.repeats, args.warmup,
+        {"nodes": total_nodes, "edges": G.num_edges()},
+    )
+
+    return results
+
+
+def build_gat_inputs(graph_encoder, idxs):
+    graphs, node_embeddings, pos_embeddings = zip(*[graph_encoder.get_graph_inputs(idx, "bench") for idx in idxs])
+    init_embeddings = torch.cat((torch.cat(pos_embeddings), torch.cat(node_embeddings)), 1)
+    return dgl.batch(graphs), init_embeddings
+
+
+def bench_ledk(args, num_nodes, config):
+    bsz, tgt_len, text_len = args.batch_size, args.target_length, args.text_length
+    torch.manual_seed(0)
+
+    text_hidden_states = torch.randn(bsz, text_len, config.d_model)
+    text_mask = torch.ones(bsz, text_len, dtype=torch.long)
+    graph_hidden_states = torch.randn(bsz, num_nodes, config.d_model)
+    graph_mask = torch.ones(bsz, num_nodes, dtype=torch.long)
+    # half of the articles have smaller graphs, as in a padded batch
+    graph_mask[bsz // 2:, num_nodes // 2:] = 0
+
+    results = {}
+
+    # decoder layer with graph cross-attention, over a full target sequence (as in training)
+    layer = LEDKDecoderLayer(config).eval()
+    hidden_states = torch.randn(bsz, tgt_len, config.d_model)
+    causal_mask = _make_causal_mask((bsz, tgt_len), hidden_states.dtype)
+    results["ledk_decoder_layer"] = benchmark(
+        lambda: layer(
+            hidden_states,
+            attention_mask=causal_mask,
+            encoder_hidden_states=text_hidden_states,
+            encoder_attention_mask=_expand_mask(text_mask, hidden_states.dtype, tgt_len=tgt_len),
+            graph_hidden_states=graph_hidden_states,
+            graph_attention_mask=_expand_mask(graph_mask, hidden_states.dtype, tgt_len=tgt_len),
+            use_cache=False,
+        ),
+        args.repeats, args.warmup, {"target_tokens": bsz * tgt_len},
+    )
+
+    # LEDKModel from precomputed encoder outputs, with and without the merged text/graph attention block
+    # (the difference is the cost of the block)
+    decoder_input_ids = torch.randint(3, config.vocab_size, (bsz, tgt_len))
+    encoder_outputs = LEDEncoderBaseModelOutput(last_hidden_state=text_hidden_states)
+    for is_merge_encoders in [False, True]:
+        model = LEDKModel(config, is_merge_encoders=is_merge_encoders, is_graph_decoder=False).eval()
+        name = "ledk_model.merge_encoders" if is_merge_encoders else "ledk_model.no_merge"
+        results[name] = benchmark(
+            lambda: model(
+                attention_mask=text_mask,
+                decoder_input_ids=decoder_input_ids,
+                encoder_outputs=encoder_outputs,
+                graph_encoder_outputs=graph_hidden_states,
+                graph_attention_mask=graph_mask,
+                use_cache=False,
+            ),
+            args.repeats, args.warmup, {"tokens": bsz * (text_len + num_nodes)},
+        )
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Latency of each benchmark relative to the baseline, and the benchmarks slower than it by more than `tolerance`.
+    """
+    comparison, regressions = {}, []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["latency_ms"] / baseline[name]["latency_ms"]
+        comparison[name] = round(ratio, 3)
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+    return comparison, regressions
+
+
+def main():
+    args = parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    config = make_tiny_led_config(d_model=args.d_model, max_length=max(2048, args.text_length))
+
+    results = {}
+    with tempfile.TemporaryDirectory() as graph_data_path:
+        for num_nodes, num_edges in GRIDS[args.grid]:
+            size = f"nodes={num_nodes},edges={num_edges}"
+            print(f"Benchmarking {size}...")
+            for name, result in bench_graph_path(args, num_nodes, num_edges, graph_data_path).items():
+                results[f"{name}[{size}]"] = result
+            for name, result in bench_ledk(args, num_nodes, config).items():
+                results[f"{name}[{size}]"] = result
+
+    for name, result in results.items():
+        print(f"{name:60s} {result['latency_ms']:>10.3f} ms  (p90 {result['latency_ms_p90']:.3f} ms, "
+              f"peak memory +{result['peak_memory_mb']} MB)")
+
+    output = {
+        "meta": {
+            "torch": torch.__version__,
+            "dgl": dgl.__version__,
+            "platform": platform.platform(),
+            "num_threads": torch.get_num_threads(),
+            "device": "cuda" if torch.cuda.is_available() else "cpu",
+            "args": vars(args),
+        },
+        "results": results,
+    }
+
+    exit_code = 0
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline = json.loads(f.read())["results"]
+        comparison, regressions = compare(results, baseline, args.tolerance)
+        output["baseline_ratio"] = comparison
+        for name, ratio in comparison.items():
+            flag = "  REGRESSION" if name in regressions else ""
+            print(f"{name:60s} {ratio:>6.2f}x baseline{flag}")
+        if regressions:
+            print(f"{len(regressions)} benchmarks are more than {args.tolerance:.0%} slower than {args.baseline}")
+            exit_code = 1
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        f.write(json.dumps(output, indent=2))
+
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
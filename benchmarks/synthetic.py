@@ -0,0 +1,106 @@
+import random
+import numpy as np
+from transformers import LEDConfig
+
+from graph_store import PE_DIM
+
+
+def make_synthetic_graph(aid, num_nodes, num_edges, num_relations=16, feature_dim=55, seed=0):
+    """
+    Random graph dict in the `*_graphs_with_features.pkl` format. Nodes are named like those of the discourse graphs
+    (document, section, semantic type and concept nodes), edges use `num_relations` distinct relation ids.
+    """
+    rng = random.Random(seed)
+
+    num_sections = min(8, max(1, num_nodes // 16))
+    num_semtypes = min(32, max(1, num_nodes // 8))
+    num_concepts = max(0, num_nodes - 1 - num_sections - num_semtypes)
+    nodes = [aid] + [f"{aid}_Sec{i}" for i in range(num_sections)] + \
+        [f"T{i:03d}" for i in range(num_semtypes)] + [f"C{i:07d}" for i in range(num_concepts)]
+
+    relations = [f"R{i}" for i in range(num_relations)]
+    edges = [[rng.choice(nodes), rng.choice(relations), rng.choice(nodes)] for _ in range(num_edges)]
+
+    features = np.random.default_rng(seed).standard_normal((len(nodes), feature_dim), dtype=np.float32)
+
+    return {"id": aid, "nodes": nodes, "edges": edges, "nfeatures": features.tolist()}
+
+
+def make_synthetic_graphs(num_graphs, num_nodes, num_edges, num_relations=16, feature_dim=55, seed=0):
+    return [
+        make_synthetic_graph(f"bench{seed}_{i}", num_nodes, num_edges, num_relations, feature_dim, seed=seed + i)
+        for i in range(num_graphs)
+    ]
+
+
+def make_synthetic_sentence(rng, vocab, min_words=6, max_words=20):
+    words = [rng.choice(vocab) for _ in range(rng.randint(min_words, max_words))]
+    return " ".join(words).capitalize() + "."
+
+
+def make_synthetic_article(aid, num_sections=3, section_sentences=10, abstract_sentences=5, summary_sentences=4, seed=0):
+    """
+    Random article in the format of the eLife `{split}.json` files (abstract, sections and summary as lists of sentences).
+    """
+    rng = random.Random(seed)
+    vocab = [f"w{i}" for i in range(500)]
+    return {
+        "id": aid,
+        "abstract": [make_synthetic_sentence(rng, vocab) for _ in range(abstract_sentences)],
+        "sections": [[make_synthetic_sentence(rng, vocab) for _ in range(section_sentences)] for _ in range(num_sections)],
+        "summary": [make_synthetic_sentence(rng, vocab) for _ in range(summary_sentences)],
+    }
+
+
+def make_synthetic_tokenizer(texts, vocab_size=1024):
+    """
+    Byte-level BPE tokenizer trained on `texts`, with the special tokens (and token ids) of `allenai/led-base-16384`.
+    """
+    from tokenizers import ByteLevelBPETokenizer
+    from tokenizers.processors import RobertaProcessing
+    from transformers import PreTrainedTokenizerFast
+
+    special_tokens = ["<s>", "<pad>", "</s>", "<unk>", "<mask>"]
+    bpe = ByteLevelBPETokenizer()
+    bpe.train_from_iterator(texts, vocab_size=vocab_size, special_tokens=special_tokens)
+    # sequences are wrapped in <s> ... </s>, as by the LED tokenizer
+    bpe._tokenizer.post_processor = RobertaProcessing(("</s>", 2), ("<s>", 0))
+    return PreTrainedTokenizerFast(
+        tokenizer_object=bpe._tokenizer,
+        bos_token="<s>", pad_token="<pad>", eos_token="</s>", unk_token="<unk>", mask_token="<mask>",
+    )
+
+
+def make_tiny_led_config(d_model=64, layers=2, heads=4, ffn_dim=128, vocab_size=1024, max_length=2048, attention_window=64):
+    """
+    Small randomly initialised LED config, with the special token ids of `allenai/led-base-16384`.
+    """
+    return LEDConfig(
+        vocab_size=vocab_size,
+        d_model=d_model,
+        encoder_layers=layers,
+        decoder_layers=layers,
+        encoder_attention_heads=heads,
+        decoder_attention_heads=heads,
+        encoder_ffn_dim=ffn_dim,
+        decoder_ffn_dim=ffn_dim,
+        max_encoder_position_embeddings=max_length,
+        max_decoder_position_embeddings=max_length // 4,
+        attention_window=[attention_window] * layers,
+        pad_token_id=1,
+        bos_token_id=0,
+        eos_token_id=2,
+        decoder_start_token_id=2,
+    )
+
+
+def make_graph_config(graph_data_path, d_model=64, feature_dim=55, heads=2):
+    """
+    Config entries used by `GraphEncoder`, for a GAT whose outputs match a model of size `d_model`.
+    """
+    return {
+        "graph_data_path": graph_data_path,
+        "GAT_dim": PE_DIM + feature_dim,
+        "GAT_embedding_size": d_model,
+        "GAT_heads": heads,
+    }
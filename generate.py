@@ -1,72 +1,390 @@
-
-import torch, sys
+import torch, os, glob, json, queue, argparse
 import numpy as np
+import torch.multiprocessing as mp
 from model import LEDKForConditionalGeneration, GraphEncoder
-from transformers import AutoTokenizer
-from utils import load_dataset, load_train_config, get_processed_elife_data
-
-
-device = 'cuda' if torch.cuda.is_available() else 'cpu'
-
-# Config
-model_dir = sys.argv[1]
-
-config = load_train_config(model_dir)
-config['batch_size'] = 16
-
-# Data
-ds = "elife"
-test = load_dataset(ds, "test")
-test = [{"idx": i, **x} for i, x in enumerate(test)]
-
-# load tokenizer
-tokenizer = AutoTokenizer.from_pretrained(model_dir)
-test_dataloader = get_processed_elife_data(ds, tokenizer, config, "test", shuffle=False)
-
-# load model 
-model = LEDKForConditionalGeneration.from_pretrained(
-    model_dir, 
-    torch_dtype=torch.float16, 
-    is_merge_encoders=config['is_merge_encoders'], 
-    is_graph_decoder=config['is_graph_decoder']
-    ).to(device)
-graph_encoder = GraphEncoder(config)
-
-# Eval loop
-model.eval()
-preds = []
-for step, batch in enumerate(test_dataloader):
-    with torch.no_grad():
-        print(step)
-        aids = batch["idx"]
-            
-        graph_enc_out = []
-        for i, aid in enumerate(aids):
-            graph_out = graph_encoder.forward(aid, "test", device)
-            graph_out = torch.nn.functional.pad(graph_out, (0,0,0,1024-graph_out.shape[0]), "constant", 0)
-            graph_enc_out.append(graph_out)
-        graph_enc_out = torch.stack(graph_enc_out, dim=1).to(torch.float16)
-        graph_enc_out = graph_enc_out.view(len(aids), -1, 1024)
-            
-        del batch['idx']
-           
+from transformers import AutoTokenizer, LEDConfig
+from transformers.models.led.modeling_led import LEDEncoderBaseModelOutput
+from metrics import StepMetrics, MetricsWriter, make_profiler, split_graph_phase, phase
+from precision import PrecisionPolicy
+from rouge_scoring import IncrementalRouge
+from quantization import quantize_model, quantize_graph_encoder
+from utils import iter_articles, load_train_config, get_tokenized_elife_data, get_elife_dataloader
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_dir", help="directory of the trained model (predictions are written there)")
+    parser.add_argument("--sweep_config", default=None,
+                        help="JSON file with a list of generation settings (e.g. num_beams, length_penalty), each decoded "
+                             "against the same encoder outputs and written to its own prediction file")
+    parser.add_argument("--num_shards", type=int, default=1, help="number of processes/nodes the test split is divided between")
+    parser.add_argument("--shard_id", type=int, default=0, help="shard of the test split generated by this process")
+    parser.add_argument("--merge", action="store_true",
+                        help="merge the per-shard outputs into ordered prediction files instead of generating")
+    parser.add_argument("--num_workers", type=int, default=1,
+                        help="number of CPU processes decoding batches in parallel against one shared copy of the model")
+    parser.add_argument("--num_threads", type=int, default=None,
+                        help="intra-op threads per worker (default: the available cores divided between workers)")
+    parser.add_argument("--quantize", action="store_true",
+                        help="dynamically quantise the linear layers of the model and GAT to int8 (CPU only)")
+    parser.add_argument("--score", action="store_true",
+                        help="score the summaries of this shard with ROUGE as they are generated")
+    parser.add_argument("--metrics_path", default=None,
+                        help="JSONL file per-batch timings and throughput are appended to (default: {model_dir}/generate_metrics.jsonl)")
+    parser.add_argument("--profile_steps", type=int, nargs=2, default=None, metavar=("START", "END"),
+                        help="record a torch profiler trace of these batches to {model_dir}/profile")
+    return parser.parse_args()
+
+
+def load_model(model_dir, config, device, torch_dtype=None):
+    if torch_dtype is None:
+        torch_dtype = PrecisionPolicy.from_config(config, device).model_dtype
+
+    model = LEDKForConditionalGeneration.from_pretrained(
+        model_dir,
+        config=LEDConfig.from_pretrained(model_dir),
+        torch_dtype=torch_dtype,
+        is_merge_encoders=config['is_merge_encoders'],
+        is_graph_decoder=config['is_graph_decoder'],
+        graph_attention_strategy=config.get('graph_attention_strategy', 'full'),
+        graph_attention_window=config.get('graph_attention_window', 512),
+        ).to(device)
+    model.eval()
+    return model
+
+
+def get_setting_name(setting):
+    if "name" in setting:
+        return setting["name"]
+    return "_".join(f"{k}={v}" for k, v in sorted(setting.items()))
+
+
+def get_shard_path(out_prefix, shard_id):
+    return f"{out_prefix}.shard{shard_id}.jsonl"
+
+
+def truncate_partial_line(path, chunk_size=1<<16):
+    """
+    Remove a partially written last line (left by a crash) from a shard file, so that appending to it starts on a
+    new line.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        pos = end
+        while pos > 0:
+            start = max(0, pos - chunk_size)
+            f.seek(start)
+            newline = f.read(pos - start).rfind(b"\n")
+            if newline != -1:
+                pos = start + newline + 1
+                break
+            pos = start
+        if pos != end:
+            f.truncate(pos)
+
+
+def read_shard_outputs(out_prefix, shard_id=None):
+    """
+    Read the generated summaries of one (or every) shard, as a dict from article index to record.
+    """
+    shard_paths = [get_shard_path(out_prefix, shard_id)] if shard_id is not None else glob.glob(get_shard_path(out_prefix, "*"))
+    records = {}
+    for shard_path in shard_paths:
+        if not os.path.exists(shard_path):
+            continue
+        with open(shard_path, "r") as f:
+            for line in f:
+                # a crash can leave a partially written last line
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                records[record['idx']] = record
+    return records
+
+
+def merge_shard_outputs(out_prefix, num_articles):
+    """
+    Write the summaries of all shards to `{out_prefix}.txt`, in the order of the split.
+    """
+    records = read_shard_outputs(out_prefix)
+    missing = [i for i in range(num_articles) if i not in records]
+    if missing:
+        raise ValueError(f"{len(missing)} articles have not been generated for {out_prefix} yet (e.g. index {missing[0]})")
+
+    with open(out_prefix + ".txt", "w") as out_f:
+        for i in range(num_articles):
+            out_f.write(records[i]['pred']+"\n")
+
+
+def encode_batch(model, graph_encoder, batch, split, device, precision, metrics=None):
+    """
+    Run the LED encoder and the graph encoder once for a batch.
+    """
+    with phase(metrics, "graph"):
+        graph_enc_out, graph_mask = graph_encoder.forward_batch(batch["idx"], split, device)
+    graph_enc_out = precision.cast_graph(graph_enc_out)
+
+    if metrics is not None:
+        metrics.count("tokens", batch["attention_mask"].sum())
+        metrics.count("graph_nodes", graph_mask.sum())
+
+    with phase(metrics, "encode"):
+        encoder_outputs = model.get_encoder()(
+            input_ids=batch["input_ids"].to(device),
+            attention_mask=batch["attention_mask"].to(device),
+            return_dict=True,
+        )
+
+    return encoder_outputs, graph_enc_out.to(device), graph_mask.to(device)
+
+
+def decode_batch(model, tokenizer, batch, encoder_outputs, graph_enc_out, graph_mask, device, metrics=None, **generate_kwargs):
+    """
+    Generate summaries for a batch from precomputed encoder/graph encoder outputs.
+    """
+    with phase(metrics, "generation"):
         generated_tokens = model.generate(
             batch["input_ids"].to(device),
-            graph_encoder_outputs=graph_enc_out.to(device), 
+            attention_mask=batch["attention_mask"].to(device),
+            # generate expands the encoder outputs in place for beam search, so each call gets its own copy
+            encoder_outputs=LEDEncoderBaseModelOutput(**encoder_outputs),
+            graph_encoder_outputs=graph_enc_out,
+            graph_attention_mask=graph_mask,
+            **generate_kwargs,
         )
 
-        if isinstance(generated_tokens, tuple):
-            generated_tokens = generated_tokens[0]
+    if isinstance(generated_tokens, tuple):
+        generated_tokens = generated_tokens[0]
 
+    with phase(metrics, "decode"):
         generated_tokens = generated_tokens.cpu().numpy()
         decoded_preds = np.where(generated_tokens != -100, generated_tokens, tokenizer.pad_token_id)
-            
-        decoded_preds = tokenizer.batch_decode(decoded_preds, skip_special_tokens=True, clean_up_tokenization_spaces=True)
-        preds.extend(decoded_preds)
+        if metrics is not None:
+            metrics.count("generated_tokens", (decoded_preds != tokenizer.pad_token_id).sum())
+
+        return tokenizer.batch_decode(decoded_preds, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+
+
+def generate_batch(model, tokenizer, graph_encoder, batch, settings, device, precision, metrics=None):
+    """
+    Encode a batch once and decode it with each generation setting, returning the summaries per setting.
+    """
+    with torch.no_grad(), precision.autocast():
+        encoder_outputs, graph_enc_out, graph_mask = encode_batch(model, graph_encoder, batch, "test", device, precision, metrics)
+        return [
+            decode_batch(model, tokenizer, batch, encoder_outputs, graph_enc_out, graph_mask, device, metrics=metrics, **setting)
+            for setting in settings
+        ]
+
+
+def generate_worker(num_threads, model, tokenizer, graph_encoder, dataset, collate_fn, steps, settings, precision, results):
+    """
+    Collate and decode the given `(step, article indices)` batches on CPU, putting `(step, idxs, preds)` on the
+    results queue.
+    """
+    torch.set_num_threads(num_threads)
+    try:
+        for step, batch_idxs in steps:
+            batch = collate_fn([dataset[i] for i in batch_idxs])
+            preds = generate_batch(model, tokenizer, graph_encoder, batch, settings, "cpu", precision)
+            results.put((step, batch["idx"].tolist(), preds))
+    finally:
+        results.put(None)
+
+
+def iter_generated_batches(model, tokenizer, graph_encoder, dataloader, settings, device, precision,
+                           num_workers=1, num_threads=None, metrics=None, poll_seconds=10):
+    """
+    Yield the article indices and per-setting summaries of each batch, in dataloader order. With several workers,
+    the batches are decoded by forked CPU processes sharing the model weights, each with its own thread budget
+    (phases are then not timed, only whole batches). Each worker only collates its own batches; a worker that dies
+    raises a RuntimeError, checked every `poll_seconds` while no results arrive.
+    """
+    if num_workers == 1:
+        for batch in dataloader:
+            if metrics is not None:
+                metrics.since_start("data")
+            yield batch["idx"].tolist(), generate_batch(model, tokenizer, graph_encoder, batch, settings, device, precision, metrics)
+        return
+
+    if device != "cpu":
+        raise ValueError("Generating with several workers is only supported on CPU")
+
+    if num_threads is None:
+        num_threads = max(1, torch.get_num_threads() // num_workers)
+
+    # weights are moved to shared memory once, forked workers then read them without copying
+    model.share_memory()
+    graph_encoder.GM.share_memory()
+    # graphs (and cached embeddings) are loaded before forking, so that the workers share them rather than each
+    # loading its own copy
+    graph_encoder.get_store("test")
+    graph_encoder.get_cache("test")
+
+    # the batches are assigned to the workers round-robin, in dataloader order
+    steps = list(enumerate(dataloader.batch_sampler))
+
+    ctx = mp.get_context("fork")
+    results = ctx.Queue()
+    workers = [
+        ctx.Process(target=generate_worker,
+                    args=(num_threads, model, tokenizer, graph_encoder, dataloader.dataset, dataloader.collate_fn,
+                          steps[i::num_workers], settings, precision, results))
+        for i in range(num_workers)
+    ]
+    for worker in workers:
+        worker.start()
+
+    try:
+        # batches finish out of order, so they are held back until all earlier ones have been yielded
+        pending, next_step, num_finished = {}, 0, 0
+        while num_finished < num_workers:
+            try:
+                result = results.get(timeout=poll_seconds)
+            except queue.Empty:
+                if any(worker.exitcode not in (None, 0) for worker in workers):
+                    raise RuntimeError("A generation worker died, rerun to generate the remaining articles")
+                continue
+            if result is None:
+                num_finished += 1
+                continue
+            step, idxs, preds = result
+            pending[step] = (idxs, preds)
+            while next_step in pending:
+                yield pending.pop(next_step)
+                next_step += 1
+        for worker in workers:
+            worker.join()
+    finally:
+        # stops the workers of a failed (or abandoned) generation
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+
+    if pending or any(worker.exitcode != 0 for worker in workers):
+        raise RuntimeError("A generation worker failed, rerun to generate the remaining articles")
+
+
+def main():
+    args = parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    # Config
+    model_dir = args.model_dir
+
+    config = load_train_config(model_dir)
+    config['batch_size'] = 16
+
+    # generation settings to decode with (the model's own generation config if no sweep is given)
+    if args.sweep_config is not None:
+        with open(args.sweep_config, "r") as f:
+            settings = json.loads(f.read())
+        out_prefixes = [f"{model_dir}/preds_{get_setting_name(setting)}" for setting in settings]
+        settings = [{k: v for k, v in setting.items() if k != "name"} for setting in settings]
+    else:
+        settings = [{}]
+        out_prefixes = [f"{model_dir}/preds"]
+
+    # Data
+    ds = "elife"
+
+    if args.merge:
+        num_articles = sum(1 for _ in iter_articles(ds, "test", columns=("id",)))
+        for out_prefix in out_prefixes:
+            merge_shard_outputs(out_prefix, num_articles)
+        return
+
+    # load tokenizer
+    tokenizer = AutoTokenizer.from_pretrained(model_dir)
+    test_data = get_tokenized_elife_data(ds, tokenizer, config, "test")
+
+    # articles of this shard that have not been generated for every setting yet
+    shard_idxs = np.array_split(np.arange(len(test_data)), args.num_shards)[args.shard_id]
+    done = [set(read_shard_outputs(out_prefix, args.shard_id)) for out_prefix in out_prefixes]
+    todo = [int(i) for i in shard_idxs if not all(i in d for d in done)]
+    print(f"shard {args.shard_id}/{args.num_shards}: {len(shard_idxs)} articles, {len(shard_idxs) - len(todo)} already generated")
+
+    test_data = test_data.select(todo)
+    idx2id = dict(zip(test_data["idx"], test_data["id"]))
+    test_dataloader = get_elife_dataloader(test_data, tokenizer, config, shuffle=False)
+
+    # load model
+    precision = PrecisionPolicy.from_config(config, device)
+    print(precision)
+    # quantisation is applied to float32 weights
+    model = load_model(model_dir, config, device, torch.float32 if args.quantize else precision.model_dtype)
+    graph_encoder = GraphEncoder(config, graph_precision=precision.graph)
+
+    if args.quantize:
+        if device != 'cpu':
+            raise ValueError("Quantised generation is only supported on CPU")
+        model = quantize_model(model)
+        graph_encoder = quantize_graph_encoder(graph_encoder)
+
+    # summaries are scored in the background as they are generated, starting with those of a previous run
+    if args.score:
+        refs = [inst['summary'] for inst in iter_articles(ds, "test", columns=("summary",))]
+        scorers = [IncrementalRouge() for _ in out_prefixes]
+        for scorer, out_prefix in zip(scorers, out_prefixes):
+            records = read_shard_outputs(out_prefix, args.shard_id)
+            scorer.add([r['pred'] for r in records.values()], [refs[i] for i in records], keys=list(records))
+
+    # per-batch timings and throughput, and an optional profiler trace
+    metrics = StepMetrics(device)
+    metrics.add_hooks(graph_encoder.GM, "gat_forward")
+    metrics.add_hooks(model.get_encoder(), "led_encoder")
+    metrics.add_hooks(model.get_decoder(), "led_decoder")
+    metrics_writer = MetricsWriter(args.metrics_path or f"{model_dir}/generate_metrics.jsonl")
+    profiler = make_profiler(args.profile_steps, f"{model_dir}/profile")
+
+    # Eval loop
+    for out_prefix in out_prefixes:
+        truncate_partial_line(get_shard_path(out_prefix, args.shard_id))
+    out_files = [open(get_shard_path(out_prefix, args.shard_id), "a") for out_prefix in out_prefixes]
+    generated_batches = iter_generated_batches(model, tokenizer, graph_encoder, test_dataloader, settings, device, precision,
+                                               num_workers=args.num_workers, num_threads=args.num_threads, metrics=metrics)
+    for step, (idxs, preds) in enumerate(generated_batches):
+        for out_f, decoded_preds in zip(out_files, preds):
+            for idx, pred in zip(idxs, decoded_preds):
+                out_f.write(json.dumps({"idx": idx, "id": idx2id[idx], "pred": pred})+"\n")
+            out_f.flush()
+
+        if args.score:
+            with metrics.phase("rouge"):
+                for scorer, decoded_preds in zip(scorers, preds):
+                    scorer.add(decoded_preds, [refs[i] for i in idxs], keys=idxs)
+
+        metrics.count("articles", len(idxs))
+        record = metrics.record(shard=args.shard_id, step=step)
+        metrics_writer.write(split_graph_phase(record))
+        if profiler is not None:
+            profiler.step()
+
+    metrics_writer.close()
+    if profiler is not None:
+        profiler.stop()
+
+    for out_f in out_files:
+        out_f.close()
+
+    if args.score:
+        for scorer, out_prefix in zip(scorers, out_prefixes):
+            result = {"num_articles": len(scorer.document_scores()), **scorer.aggregate()}
+            print(out_prefix, result)
+            with open(f"{out_prefix}.shard{args.shard_id}_rouge.json", "w") as f:
+                f.write(json.dumps(result, indent=2))
+            scorer.close()
 
-with open(model_dir+"/preds.txt", "w") as out_f:
-    for p in preds:
-        out_f.write(p+"\n")
+    # a single process has generated everything, so the ordered prediction files can be written directly
+    if args.num_shards == 1:
+        for out_prefix in out_prefixes:
+            merge_shard_outputs(out_prefix, len(shard_idxs))
 
-            
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+import os
+import sys
+import json
+import shutil
+import hashlib
+import numpy as np
+import torch
+
+
+def gat_weights_hash(GM):
+    """
+    Hash of the GAT parameters, used to key the embedding cache so that stale caches are never read.
+    """
+    h = hashlib.sha1()
+    for name, tensor in sorted(GM.state_dict().items()):
+        h.update(name.encode())
+        h.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()[:16]
+
+
+def graph_store_hash(store, chunk_size=1 << 24):
+    """
+    Hash of the compiled graphs of a split (ids, structure, node features and positional encodings), used to key the
+    embedding cache so that embeddings of graphs that have since been rebuilt (e.g. recompacted) are never read.
+    """
+    h = hashlib.sha1()
+    h.update(json.dumps(store.ids).encode())
+    for name in ["node_offsets", "edge_offsets", "src", "dst", "nfeatures", "pe"]:
+        arr = getattr(store, name)
+        if arr is None:
+            continue
+        h.update(f"{name}{arr.shape}{arr.dtype}".encode())
+        # memory-mapped arrays are hashed in chunks of rows
+        flat = arr.reshape(len(arr), -1) if arr.ndim > 1 else arr.reshape(-1, 1)
+        rows = max(1, chunk_size // max(1, flat.shape[1] * flat.itemsize))
+        for start in range(0, len(flat), rows):
+            h.update(np.ascontiguousarray(flat[start:start+rows]).tobytes())
+    return h.hexdigest()[:16]
+
+
+# numpy dtype the graph embeddings are cached in for each graph precision of the PrecisionPolicy, so that cached and
+# uncached embeddings are the same once cast (numpy has no bf16, so those are cached in float32)
+CACHE_DTYPES = {"fp32": "float32", "bf16": "float32", "fp16": "float16"}
+
+
+def get_cache_path(cache_dir, split, weights_hash, store_hash, dtype):
+    return f"{cache_dir}/{split}_{weights_hash}_{store_hash}_{dtype}"
+
+
+def is_cache(cache_path):
+    return os.path.exists(f"{cache_path}/embeddings.npy") and os.path.exists(f"{cache_path}/ids.json")
+
+
+def save_gat_weights(GM, cache_dir):
+    os.makedirs(cache_dir, exist_ok=True)
+    torch.save(GM.state_dict(), f"{cache_dir}/gat.pt")
+
+
+def load_gat_weights(GM, cache_dir):
+    """
+    Load the GAT weights the cache in `cache_dir` was built with, if any. Returns whether weights were loaded.
+    """
+    if not os.path.exists(f"{cache_dir}/gat.pt"):
+        return False
+    GM.load_state_dict(torch.load(f"{cache_dir}/gat.pt", map_location="cpu"))
+    return True
+
+
+class GraphEmbeddingCache():
+    """
+    Memory-mapped GAT outputs of one split, *(total_nodes, dim)*, with rows of each article located by its id.
+    """
+    def __init__(self, ids, node_offsets, embeddings):
+        self.ids = ids
+        self.id2idx = {aid: i for i, aid in enumerate(ids)}
+        self.node_offsets = node_offsets
+        self.embeddings = embeddings
+
+    @classmethod
+    def load(cls, cache_path):
+        with open(f"{cache_path}/ids.json", "r") as f:
+            ids = json.loads(f.read())
+        node_offsets = np.load(f"{cache_path}/node_offsets.npy")
+        embeddings = np.load(f"{cache_path}/embeddings.npy", mmap_mode='r')
+        return cls(ids, node_offsets, embeddings)
+
+    def __contains__(self, article_id):
+        return article_id in self.id2idx
+
+    def num_nodes(self, article_id):
+        i = self.id2idx[article_id]
+        return int(self.node_offsets[i+1] - self.node_offsets[i])
+
+    def get_embeddings(self, article_id):
+        i = self.id2idx[article_id]
+        start, end = self.node_offsets[i], self.node_offsets[i+1]
+        return torch.from_numpy(np.array(self.embeddings[start:end], dtype=np.float32))
+
+
+def build_graph_cache(graph_encoder, split, cache_dir, device, batch_size=16):
+    """
+    Run the GAT once over every graph of a split and write its outputs to a memory-mapped cache, in the dtype of the
+    graph encoder's graph precision. A complete cache built with the same weights, graphs and dtype is kept as is.
+    """
+    store = graph_encoder.get_store(split)
+    dtype = graph_encoder.cache_dtype
+    cache_path = get_cache_path(cache_dir, split, gat_weights_hash(graph_encoder.GM), graph_store_hash(store), dtype)
+    if is_cache(cache_path):
+        return cache_path
+
+    # written next to the cache and moved into place once complete, so that an interrupted build leaves no cache
+    partial_path = f"{cache_path}.partial{os.getpid()}"
+    shutil.rmtree(partial_path, ignore_errors=True)
+    os.makedirs(partial_path)
+
+    total_nodes = int(store.node_offsets[-1])
+    dim = graph_encoder.embedding_size
+    embeddings = np.lib.format.open_memmap(f"{partial_path}/embeddings.npy", mode="w+", dtype=dtype, shape=(total_nodes, dim))
+
+    with torch.no_grad():
+        for start in range(0, len(store), batch_size):
+            idxs = list(range(start, min(start + batch_size, len(store))))
+            # always the GAT itself, never an existing cache
+            graph_embeddings, _ = graph_encoder.encode_graphs([graph_encoder.get_graph_inputs(idx, split) for idx in idxs], device)
+            embeddings[store.node_offsets[idxs[0]]:store.node_offsets[idxs[-1]+1]] = graph_embeddings.cpu().numpy()
+
+    embeddings.flush()
+    del embeddings
+    np.save(f"{partial_path}/node_offsets.npy", np.asarray(store.node_offsets))
+    with open(f"{partial_path}/ids.json", "w") as f:
+        f.write(json.dumps(store.ids))
+
+    # a cache left by an interrupted build of an earlier version (without ids.json) is replaced
+    shutil.rmtree(cache_path, ignore_errors=True)
+    os.replace(partial_path, cache_path)
+
+    return cache_path
+
+
+if __name__ == "__main__":
+    # Usage: python graph_cache.py {config_path} [split ...]
+    from model import GraphEncoder
+    from precision import PrecisionPolicy
+    from utils import load_train_config
+
+    config = load_train_config(sys.argv[1])
+    splits = sys.argv[2:] if len(sys.argv) > 2 else ["train", "val", "test"]
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    cache_dir = config['graph_cache_dir']
+    # cached in the precision the embeddings are handed to the model in on this device
+    graph_encoder = GraphEncoder(config, graph_precision=PrecisionPolicy.from_config(config, device).graph)
+    if not load_gat_weights(graph_encoder.GM, cache_dir):
+        save_gat_weights(graph_encoder.GM, cache_dir)
+
+    for split in splits:
+        cache_path = build_graph_cache(graph_encoder, split, cache_dir, device, batch_size=config['batch_size'])
+        print(f"{split}: cached graph embeddings at {cache_path}")
@@ -0,0 +1,146 @@
+import re
+import sys
+import json
+from collections import Counter
+
+ds = "eLife"
+
+# Usage: python compact_graphs.py [max_nodes] [max_edges] [pagerank|degree]
+MAX_NODES = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+MAX_EDGES = int(sys.argv[2]) if len(sys.argv) > 2 else 8192
+SCORE = sys.argv[3] if len(sys.argv) > 3 else "pagerank"
+
+
+def is_concept_node(node_id):
+    return re.match(r'^[C][0-9]{7}', node_id)
+
+def is_semtype_node(node_id):
+    return re.match(r'^[T][0-9]{3}', node_id)
+
+def get_node_type(aid, node, title_nodes=()):
+    if node == aid:
+        return "document"
+    if node.startswith(aid + "_Abs") or node.startswith(aid + "_Sec"):
+        return "section"
+    if node in title_nodes:
+        return "title"
+    if is_semtype_node(node):
+        return "semtype"
+    if is_concept_node(node):
+        return "concept"
+    return "metadata"
+
+# structural nodes that are never dropped (titles are used for the features of their document/section nodes)
+PROTECTED_TYPES = {"document", "section", "title", "semtype"}
+# relations whose edges are never dropped
+PROTECTED_RELATIONS = {"has_title"}
+
+
+def degree_scores(nodes, edges):
+    degree = Counter()
+    for n1, _, n2 in edges:
+        degree[n1] += 1
+        degree[n2] += 1
+    return {n: float(degree[n]) for n in nodes}
+
+
+def pagerank_scores(nodes, edges, damping=0.85, iters=20):
+    # PageRank over the undirected graph
+    neighbours = {n: [] for n in nodes}
+    for n1, _, n2 in edges:
+        neighbours[n1].append(n2)
+        neighbours[n2].append(n1)
+
+    num_nodes = len(nodes)
+    rank = {n: 1.0 / num_nodes for n in nodes}
+    for _ in range(iters):
+        new_rank = {n: (1 - damping) / num_nodes for n in nodes}
+        dangling = sum(rank[n] for n in nodes if not neighbours[n])
+        for n in nodes:
+            if neighbours[n]:
+                share = damping * rank[n] / len(neighbours[n])
+                for m in neighbours[n]:
+                    new_rank[m] += share
+        for n in nodes:
+            new_rank[n] += damping * dangling / num_nodes
+        rank = new_rank
+    return rank
+
+
+def compact_graph(d, max_nodes=MAX_NODES, max_edges=MAX_EDGES, score=SCORE):
+    """
+    Cap a graph at `max_nodes` nodes and `max_edges` edges, keeping the highest scoring nodes/edges.
+    Document, section, title and semantic type nodes, and `has_title` edges, are always kept.
+    """
+    nodes = d['nodes']
+    edges = d['edges']
+    aid = d['id']
+
+    title_nodes = {e[2] for e in edges if e[1] in PROTECTED_RELATIONS}
+    node_types = {n: get_node_type(aid, n, title_nodes) for n in nodes}
+    scores = pagerank_scores(nodes, edges) if score == "pagerank" else degree_scores(nodes, edges)
+
+    protected = [n for n in nodes if node_types[n] in PROTECTED_TYPES]
+    candidates = sorted([n for n in nodes if node_types[n] not in PROTECTED_TYPES], key=lambda n: -scores[n])
+    keep = set(protected) | set(candidates[:max(0, max_nodes - len(protected))])
+
+    new_nodes = [n for n in nodes if n in keep]
+    new_edges = [e for e in edges if e[0] in keep and e[2] in keep]
+
+    # edges between the most important nodes are kept, those touching structural nodes first
+    if len(new_edges) > max_edges:
+        def edge_score(e):
+            is_structural = node_types[e[0]] in PROTECTED_TYPES or node_types[e[2]] in PROTECTED_TYPES
+            return (is_structural, scores[e[0]] + scores[e[2]])
+        required = [e for e in new_edges if e[1] in PROTECTED_RELATIONS]
+        others = sorted([e for e in new_edges if e[1] not in PROTECTED_RELATIONS], key=edge_score, reverse=True)
+        new_edges = required + others[:max(0, max_edges - len(required))]
+
+    stats = {
+        "nodes_before": len(nodes),
+        "nodes_after": len(new_nodes),
+        "edges_before": len(edges),
+        "edges_after": len(new_edges),
+        "dropped_node_types": Counter(node_types[n] for n in nodes if n not in keep),
+    }
+
+    d['nodes'] = new_nodes
+    d['edges'] = new_edges
+
+    return d, stats
+
+
+if __name__ == "__main__":
+    for split in ["train", "val", "test"]:
+
+        split_stats = {
+            "max_nodes": MAX_NODES, "max_edges": MAX_EDGES, "score": SCORE,
+            "graphs": 0, "graphs_compacted": 0,
+            "nodes_before": 0, "nodes_after": 0, "edges_before": 0, "edges_after": 0,
+            "max_nodes_before": 0, "max_edges_before": 0,
+            "dropped_node_types": Counter(),
+        }
+
+        out_file = open(f"./{ds}_split/{split}_disc_graphs_compact.jsonl", "w")
+
+        with open(f"./{ds}_split/{split}_disc_graphs_complete.jsonl", "r") as in_file:
+
+            for line in in_file:
+                d, stats = compact_graph(json.loads(line))
+                out_file.write(json.dumps(d))
+                out_file.write("\n")
+
+                split_stats["graphs"] += 1
+                split_stats["graphs_compacted"] += int(stats["nodes_after"] < stats["nodes_before"] or stats["edges_after"] < stats["edges_before"])
+                for k in ["nodes_before", "nodes_after", "edges_before", "edges_after"]:
+                    split_stats[k] += stats[k]
+                split_stats["max_nodes_before"] = max(split_stats["max_nodes_before"], stats["nodes_before"])
+                split_stats["max_edges_before"] = max(split_stats["max_edges_before"], stats["edges_before"])
+                split_stats["dropped_node_types"].update(stats["dropped_node_types"])
+
+        out_file.close()
+
+        with open(f"./{ds}_split/{split}_compaction_stats.json", "w") as stats_file:
+            stats_file.write(json.dumps(split_stats, indent=2))
+
+        print(split, json.dumps(split_stats))
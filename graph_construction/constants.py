@@ -46,6 +46,8 @@ UMLS_TEXT2GRAPH_FILE = join(BASE_PATH, 'resources/text2graph.pkl')
 UMLS_EMBS_SIZE = 50 # https://github.com/r-mal/umls-embeddings
 # METAMAP_PATH = '/shared/nas/data/m1/tuanml2/software/public_mm/bin/metamap20'
 METAMAP_PATH = '/home/tomas/models/public_mm/bin/metamap20'
+# sentences sent to MetaMapLite per call
+METAMAP_BATCH_SIZE = 256
 
 MM_TYPES = ['aapp', 'acab', 'acty', 'aggp', 'amas', 'amph', 'anab', 'anim',
             'anst', 'antb', 'arch', 'bacs', 'bact', 'bdsu', 'bdsy', 'bhvr',
@@ -36,9 +36,35 @@ def load_datafile(fp):
   return ids, sections, section_names, abstracts, titles, keywords, years
 
 
+def get_document_concepts(document_dict):
+  """
+  Concepts of the abstract and of each section, extracted with a single (batched) MetaMapLite call per document.
+  """
+  # (section index or None for the abstract, sentence)
+  sents = []
+  if document_dict['abstract'] != "":
+    sents.append((None, " ".join(document_dict['abstract']).strip()))
+  for i, section in enumerate(document_dict['sections']):
+    sents.extend((i, sent) for sent in section)
+
+  search_results, _ = umls_search_concepts([sent for _, sent in sents])
+
+  abstract_concepts, section_concepts = [], [[] for _ in document_dict['sections']]
+  for result in search_results:
+    section_idx = sents[result['sent_idx']][0]
+    if section_idx is None:
+      abstract_concepts.extend(result['concepts'])
+    else:
+      section_concepts[section_idx].extend(result['concepts'])
+
+  return abstract_concepts, section_concepts
+
+
 def get_discourse_graph(document_dict):
   nodes = set()
   edges = set()
+
+  abstract_concepts, section_concepts = get_document_concepts(document_dict)
   
   nodes.add(document_dict['id']) # document node
 
@@ -59,12 +85,8 @@ def get_discourse_graph(document_dict):
     nodes.add(abstract_node)
     edges.add((document_dict['id'], Discourse_Relations.CONTAINS.value, abstract_node))
 
-    abstract = " ".join(document_dict['abstract']).strip()
-
     # Abstract sentence nodes / relations
-    kg_concepts = umls_search_concepts([abstract])[0][0]['concepts']
-
-    for c in kg_concepts:
+    for c in abstract_concepts:
       nodes.add(c['cui'])
       edges.add((abstract_node, Discourse_Relations.CONTAINS.value, c['cui']))
 
@@ -93,11 +115,7 @@ def get_discourse_graph(document_dict):
     nodes.add(section_heading)
     edges.add((sec_node, Discourse_Relations.HAS_TITLE.value, section_heading))
 
-    kg_concepts = []
-    for sent in section:
-      kg_concepts.append(umls_search_concepts([sent])[0][0]['concepts'])
-
-    for c in kg_concepts:
+    for c in section_concepts[i]:
       nodes.add(c['cui'])
       edges.add((sec_node, Discourse_Relations.CONTAINS.value, c['cui']))
 
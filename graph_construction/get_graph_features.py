@@ -1,9 +1,11 @@
 from transformers import AutoTokenizer, AutoModel
 import pickle
 import torch
+import dgl
 import json
 import torch.nn as nn
 import re
+import os
 from enum import Enum
 
 
@@ -69,6 +71,15 @@ def get_sentence_embeddings(sents, is_project=False):
     else:
         return pool
 
+def get_random_walk_pe(nodes, edges, k=16):
+    # same graph as used by the GAT: node indices follow `nodes`, with self loops added
+    node2idx = {n: i for i, n in enumerate(nodes)}
+    src = [node2idx[e[0]] for e in edges]
+    dst = [node2idx[e[2]] for e in edges]
+    G = dgl.graph((torch.tensor(src, dtype=torch.int64), torch.tensor(dst, dtype=torch.int64)), num_nodes=len(nodes))
+    G = dgl.add_self_loop(G)
+    return dgl.random_walk_pe(G, k)
+
 def get_initial_embeddings(aid, nodes, edges):
     ret_nodes, ret_embs = [], []
     has_title_edges = [e for e in edges if e[1] == "has_title"]
@@ -111,7 +122,12 @@ ds = "eLife"
 for split in ['train', 'val', 'test']:
     out_graphs = []
 
-    with open(f"./{ds}_split/{split}_disc_graphs_complete.jsonl", "r") as in_file:
+    # use the compacted graphs (compact_graphs.py) if they have been created
+    graph_file = f"./{ds}_split/{split}_disc_graphs_compact.jsonl"
+    if not os.path.exists(graph_file):
+        graph_file = f"./{ds}_split/{split}_disc_graphs_complete.jsonl"
+
+    with open(graph_file, "r") as in_file:
         graphs = [json.loads(line) for line in in_file.readlines()]
 
     for i, graph in enumerate(graphs):
@@ -127,6 +143,7 @@ for split in ['train', 'val', 'test']:
         graph['nodes'] = final_nodes
         graph['edges'] = final_edges
         graph['nfeatures'] = embeddings
+        graph['pe'] = get_random_walk_pe(final_nodes, final_edges).tolist()
         out_graphs.append(graph)
 
     pickle.dump(out_graphs, open(f"./{ds}_split/{split}_graphs_with_features.pkl", 'wb'))
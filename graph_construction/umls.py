@@ -10,82 +10,144 @@ from metamaplite import MetaMapLite  # Changed to pymetamaplite
 from sqlitedict import SqliteDict
 from utils import create_dir_if_not_exist
 
-# Main Functions
-def umls_search_concepts(sents, prune=False, filtered_types = MM_TYPES):
-    create_dir_if_not_exist(CACHE_DIR)
-    search_results, cache_used, api_called = [], 0, 0
-    sqlitedict = SqliteDict(UMLS_CONCEPTS_SQLITE, autocommit=True)
-    
-    # Initialize MetaMapLite instead of MetaMap
-    METAMAP = MetaMapLite()
-
-    for sent_idx, sent in enumerate(sents):
-        # Use MetaMapLite API
-        api_called += 1
-        
-        if not prune:
-            # Extract concepts using pymetamaplite's extract_concepts method
-            raw_concepts, error = METAMAP.extract_concepts([sent])
-        else:
+class ConceptExtractor():
+    """
+    One MetaMapLite session and concept cache per process, shared by every call. Sentences are sent to MetaMapLite
+    in batches of `batch_size` (each with its index in the batch as id) and the concepts mapped back to their sentence.
+    """
+    def __init__(self, batch_size=METAMAP_BATCH_SIZE):
+        create_dir_if_not_exist(CACHE_DIR)
+        self.batch_size = batch_size
+        self.metamap = MetaMapLite()
+        # raw concepts of every sentence seen so far, committed once per batch
+        self.sqlitedict = SqliteDict(UMLS_CONCEPTS_SQLITE, autocommit=False)
+
+    def get_cache_key(self, sent, prune):
+        return "prune|" + sent if prune else sent
+
+    def extract_batch(self, sents, prune=False, filtered_types=MM_TYPES):
+        """
+        Raw concepts of each sentence, from a single MetaMapLite call.
+        """
+        # one sentence per line
+        sents = [sent.replace("\n", " ") for sent in sents]
+        kwargs = {}
+        if prune:
             # For prune=True, specify additional parameters as per pymetamaplite's API
-            raw_concepts, error = METAMAP.extract_concepts(
-                [sent],
+            kwargs = dict(
                 word_sense_disambiguation=True,  # Enable word sense disambiguation
                 filter_by_type=filtered_types,   # Optionally filter concepts by semantic types
                 prune_concepts=True,             # If you want to prune based on certain criteria
             )
+        raw_concepts, error = self.metamap.extract_concepts(sents, ids=list(range(len(sents))), **kwargs)
 
         # Handle error if extraction fails
-        if error is None:
-            sqlitedict[sent] = raw_concepts
-        else:
+        if error is not None:
             raise Exception(f"Error extracting concepts: {error}")
 
-        # Processing raw concepts
-        processed_concepts = []
+        concepts = [[] for _ in sents]
         for concept in raw_concepts:
-            should_skip = False
-            # Semantic Types
-            semtypes = set(concept['semtypes'])  # Adjust based on pymetamaplite's output
-            if len(semtypes.intersection(filtered_types)) == 0:
-                continue  # Skip if the concept does not match the filtered types
-            semtypes = list(semtypes); semtypes.sort()
-
-            # Offset Locations
-            pos_info = concept['pos_info']  # Adjust based on pymetamaplite's output
-            pos_info = pos_info.replace(';', ',')
-            pos_info = pos_info.replace('[', '')
-            pos_info = pos_info.replace(']', '')
-            pos_infos = pos_info.split(',')
-
-            for pos_info in pos_infos:
-                try:
-                    start, length = [int(a) for a in pos_info.split('/')]
-                except:
-                    print('Skipped', pos_info)
-                    start = 0
-                    length = 0
-                    continue
-                
-                start_char = start - 1
-                end_char = start + length - 1
-
-                # Heuristics Rules
-                concept_text = sent[start_char:end_char]
-                if concept_text == 'A': continue
-                if concept_text == 'to': continue
-
-                # Update processed_concepts
-                processed_concepts.append({
-                    'cui': concept['cui'], 'semtypes': semtypes,
-                    'start_char': start_char, 'end_char': end_char,
-                    "score": concept['score'], "preferred_name": concept['preferred_name'],
-                    "trigger": concept['trigger']
-                })
-
-        search_results.append({
-            'sent_idx': sent_idx, 'concepts': processed_concepts
-        })
-    
-    sqlitedict.close()
+            # ids come back as their repr
+            concepts[int(str(concept['index']).strip("'\""))].append(concept)
+        return concepts
+
+    def extract(self, sents, prune=False, filtered_types=MM_TYPES):
+        """
+        Raw concepts of each sentence, from the cache or from MetaMapLite. Returns the concepts and the number of
+        sentences found in the cache and MetaMapLite calls made.
+        """
+        raw_concepts = [None] * len(sents)
+        todo = {}
+        for sent_idx, sent in enumerate(sents):
+            key = self.get_cache_key(sent, prune)
+            if key in self.sqlitedict:
+                raw_concepts[sent_idx] = self.sqlitedict[key]
+            else:
+                # repeated sentences are only extracted once
+                todo.setdefault(sent, []).append(sent_idx)
+        cache_used = len(sents) - sum(len(idxs) for idxs in todo.values())
+
+        todo_sents, api_called = list(todo), 0
+        for start in range(0, len(todo_sents), self.batch_size):
+            batch = todo_sents[start:start+self.batch_size]
+            api_called += 1
+            for sent, concepts in zip(batch, self.extract_batch(batch, prune, filtered_types)):
+                self.sqlitedict[self.get_cache_key(sent, prune)] = concepts
+                for sent_idx in todo[sent]:
+                    raw_concepts[sent_idx] = concepts
+            self.sqlitedict.commit()
+
+        return raw_concepts, cache_used, api_called
+
+    def close(self):
+        self.sqlitedict.close()
+
+
+# extractor of this process, created on first use
+CONCEPT_EXTRACTOR = None
+
+
+def get_concept_extractor():
+    global CONCEPT_EXTRACTOR
+    if CONCEPT_EXTRACTOR is None:
+        CONCEPT_EXTRACTOR = ConceptExtractor()
+    return CONCEPT_EXTRACTOR
+
+
+def process_concepts(sent, raw_concepts, filtered_types=MM_TYPES):
+    """
+    Concepts of a sentence with one of the `filtered_types` semantic types, one per occurrence (with its character span).
+    """
+    processed_concepts = []
+    for concept in raw_concepts:
+        # Semantic Types
+        semtypes = set(concept['semtypes'])  # Adjust based on pymetamaplite's output
+        if len(semtypes.intersection(filtered_types)) == 0:
+            continue  # Skip if the concept does not match the filtered types
+        semtypes = list(semtypes); semtypes.sort()
+
+        # Offset Locations
+        pos_info = concept['pos_info']  # Adjust based on pymetamaplite's output
+        pos_info = pos_info.replace(';', ',')
+        pos_info = pos_info.replace('[', '')
+        pos_info = pos_info.replace(']', '')
+        pos_infos = pos_info.split(',')
+
+        for pos_info in pos_infos:
+            try:
+                start, length = [int(a) for a in pos_info.split('/')]
+            except:
+                print('Skipped', pos_info)
+                continue
+            
+            start_char = start - 1
+            end_char = start + length - 1
+
+            # Heuristics Rules
+            concept_text = sent[start_char:end_char]
+            if concept_text == 'A': continue
+            if concept_text == 'to': continue
+
+            # Update processed_concepts
+            processed_concepts.append({
+                'cui': concept['cui'], 'semtypes': semtypes,
+                'start_char': start_char, 'end_char': end_char,
+                "score": concept['score'], "preferred_name": concept['preferred_name'],
+                "trigger": concept['trigger']
+            })
+    return processed_concepts
+
+
+# Main Functions
+def umls_search_concepts(sents, prune=False, filtered_types = MM_TYPES):
+    """
+    Concepts of each sentence, as a list of {'sent_idx', 'concepts'} dicts in the order of `sents`. Sentences are
+    extracted in batches by the process's `ConceptExtractor`, so many sentences should be passed per call.
+    """
+    raw_concepts, cache_used, api_called = get_concept_extractor().extract(sents, prune, filtered_types)
+
+    search_results = [
+        {'sent_idx': sent_idx, 'concepts': process_concepts(sent, concepts, filtered_types)}
+        for sent_idx, (sent, concepts) in enumerate(zip(sents, raw_concepts))
+    ]
     return search_results, {'cache_used': cache_used, 'api_called': api_called}
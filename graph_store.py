@@ -0,0 +1,164 @@
+import os
+import sys
+import json
+import pickle
+import numpy as np
+import torch
+import dgl
+
+
+SPLITS = ["train", "val", "test"]
+PE_DIM = 16
+
+
+def compile_graph(nodes, edges):
+    """
+    Convert a graph given as string nodes and (src, rel, tgt) triples into integer COO arrays.
+    Self loops are appended for every node, matching `dgl.add_self_loop` on the homogeneous graph.
+    """
+    node2idx = {n: i for i, n in enumerate(nodes)}
+    num_nodes = len(nodes)
+
+    src = np.fromiter((node2idx[n1] for n1, _, _ in edges), dtype=np.int64, count=len(edges))
+    dst = np.fromiter((node2idx[n2] for _, _, n2 in edges), dtype=np.int64, count=len(edges))
+
+    self_loops = np.arange(num_nodes, dtype=np.int64)
+    src = np.concatenate((src, self_loops))
+    dst = np.concatenate((dst, self_loops))
+
+    return num_nodes, src, dst
+
+
+def random_walk_pe(num_nodes, src, dst, k=PE_DIM):
+    """
+    Random-walk positional encodings of a compiled graph (as computed by `dgl.random_walk_pe`).
+    """
+    G = dgl.graph((torch.from_numpy(src), torch.from_numpy(dst)), num_nodes=num_nodes)
+    return dgl.random_walk_pe(G, k).numpy()
+
+
+def compile_graphs(graphs, store_dir=None, feature_dtype="float32"):
+    """
+    Compile a list of graph dicts (as stored in `*_graphs_with_features.pkl`) into flat arrays.
+    Edges of article i are `src[edge_offsets[i]:edge_offsets[i+1]]` (local node indices), its nodes
+    (and rows of `nfeatures` and `pe`) span `node_offsets[i]:node_offsets[i+1]`. Random-walk positional
+    encodings stored with the graphs (`pe`, see get_graph_features.py) are used if present, otherwise they
+    are computed here. If `store_dir` is given, the arrays are written there.
+    """
+    ids, num_nodes, num_edges, all_src, all_dst, all_feats, all_pe = [], [], [], [], [], [], []
+    for graph in graphs:
+        n, src, dst = compile_graph(graph['nodes'], graph['edges'])
+        ids.append(graph['id'])
+        num_nodes.append(n)
+        num_edges.append(len(src))
+        all_src.append(src.astype(np.int32))
+        all_dst.append(dst.astype(np.int32))
+        all_feats.append(np.asarray(graph['nfeatures'], dtype=feature_dtype).reshape(n, -1))
+        if 'pe' in graph:
+            all_pe.append(np.asarray(graph['pe'], dtype=np.float32).reshape(n, PE_DIM))
+        else:
+            all_pe.append(random_walk_pe(n, src, dst).astype(np.float32))
+
+    arrays = {
+        "node_offsets": np.concatenate(([0], np.cumsum(num_nodes))).astype(np.int64),
+        "edge_offsets": np.concatenate(([0], np.cumsum(num_edges))).astype(np.int64),
+        "src": np.concatenate(all_src) if all_src else np.zeros(0, dtype=np.int32),
+        "dst": np.concatenate(all_dst) if all_dst else np.zeros(0, dtype=np.int32),
+        "nfeatures": np.concatenate(all_feats) if all_feats else np.zeros((0, 0), dtype=feature_dtype),
+        "pe": np.concatenate(all_pe) if all_pe else np.zeros((0, PE_DIM), dtype=np.float32),
+    }
+
+    if store_dir is not None:
+        os.makedirs(store_dir, exist_ok=True)
+        for name, arr in arrays.items():
+            np.save(f"{store_dir}/{name}.npy", arr)
+        with open(f"{store_dir}/ids.json", "w") as f:
+            f.write(json.dumps(ids))
+
+    return ids, arrays
+
+
+STORE_ARRAYS = ["node_offsets", "edge_offsets", "src", "dst", "nfeatures"]
+
+
+def get_store_dir(graph_data_path, split):
+    return f"{graph_data_path}/{split}_graph_store"
+
+
+def is_store(store_dir):
+    return all(os.path.exists(f"{store_dir}/{name}.npy") for name in STORE_ARRAYS) and \
+        os.path.exists(f"{store_dir}/ids.json")
+
+
+class GraphStore():
+    """
+    Read-only access to the compiled graphs of one split. When loaded from disk, all arrays are
+    memory-mapped, so only the rows of the articles actually used are read.
+    """
+    def __init__(self, ids, arrays):
+        self.ids = ids
+        self.id2idx = {aid: i for i, aid in enumerate(ids)}
+        self.node_offsets = arrays['node_offsets']
+        self.edge_offsets = arrays['edge_offsets']
+        self.src = arrays['src']
+        self.dst = arrays['dst']
+        self.nfeatures = arrays['nfeatures']
+        self.pe = arrays.get('pe')
+
+    @classmethod
+    def load(cls, store_dir):
+        with open(f"{store_dir}/ids.json", "r") as f:
+            ids = json.loads(f.read())
+        arrays = {name: np.load(f"{store_dir}/{name}.npy", mmap_mode='r') for name in STORE_ARRAYS}
+        # stores compiled without positional encodings fall back to computing them on the fly
+        if os.path.exists(f"{store_dir}/pe.npy"):
+            arrays['pe'] = np.load(f"{store_dir}/pe.npy", mmap_mode='r')
+        return cls(ids, arrays)
+
+    @classmethod
+    def from_graphs(cls, graphs):
+        return cls(*compile_graphs(graphs))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def index(self, article_id):
+        return self.id2idx[article_id]
+
+    def num_nodes(self, idx):
+        idx = int(idx)
+        return int(self.node_offsets[idx+1] - self.node_offsets[idx])
+
+    def get_edges(self, idx):
+        idx = int(idx)
+        start, end = self.edge_offsets[idx], self.edge_offsets[idx+1]
+        src = torch.from_numpy(self.src[start:end].astype(np.int64))
+        dst = torch.from_numpy(self.dst[start:end].astype(np.int64))
+        return src, dst
+
+    def get_features(self, idx):
+        idx = int(idx)
+        start, end = self.node_offsets[idx], self.node_offsets[idx+1]
+        return torch.from_numpy(np.array(self.nfeatures[start:end], dtype=np.float32))
+
+    def get_pe(self, idx):
+        if self.pe is None:
+            return None
+        idx = int(idx)
+        start, end = self.node_offsets[idx], self.node_offsets[idx+1]
+        return torch.from_numpy(np.array(self.pe[start:end], dtype=np.float32))
+
+    def get_graph(self, idx):
+        return dgl.graph(self.get_edges(idx), num_nodes=self.num_nodes(idx))
+
+
+if __name__ == "__main__":
+    # Usage: python graph_store.py {graph_data_path} [float32|float16]
+    graph_data_path = sys.argv[1]
+    feature_dtype = sys.argv[2] if len(sys.argv) > 2 else "float32"
+
+    for split in SPLITS:
+        graphs = pickle.load(open(f"{graph_data_path}/{split}_graphs_with_features.pkl", 'rb'))
+        ids, arrays = compile_graphs(graphs, get_store_dir(graph_data_path, split), feature_dtype)
+        del graphs
+        print(f"{split}: {len(ids)} graphs, {arrays['node_offsets'][-1]} nodes, {arrays['edge_offsets'][-1]} edges")
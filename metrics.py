@@ -0,0 +1,144 @@
+import json
+import time
+import resource
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+import torch
+from torch.profiler import ProfilerActivity
+
+
+class StepMetrics():
+    """
+    Wall-clock time of the named phases of a step, and counters (e.g. tokens, graph nodes), turned into a metrics record
+    with throughput and peak memory. On CUDA, the device is synchronised at phase boundaries (unless `sync` is False) so
+    that asynchronous kernels are attributed to the phase that launched them.
+    """
+    def __init__(self, device, sync=True):
+        self.device_type = torch.device(device).type
+        self.sync = sync and self.device_type == "cuda"
+        self.hook_starts = {}
+        self.reset()
+
+    def reset(self):
+        self.times = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.start = time.perf_counter()
+        if self.device_type == "cuda":
+            torch.cuda.reset_peak_memory_stats()
+
+    def synchronize(self):
+        if self.sync:
+            torch.cuda.synchronize()
+
+    @contextmanager
+    def phase(self, name):
+        self.synchronize()
+        start = time.perf_counter()
+        try:
+            # phases are labelled in profiler traces too
+            with torch.profiler.record_function(name):
+                yield
+        finally:
+            self.synchronize()
+            self.times[name] += time.perf_counter() - start
+
+    def since_start(self, name):
+        """
+        Attribute the time since the step started (e.g. waiting for the DataLoader) to phase `name`.
+        """
+        self.times[name] += time.perf_counter() - self.start
+
+    def add_hooks(self, module, name):
+        """
+        Time every forward pass of `module` as phase `name`.
+        """
+        def pre_hook(module, inputs):
+            self.synchronize()
+            self.hook_starts[name] = time.perf_counter()
+
+        def hook(module, inputs, outputs):
+            self.synchronize()
+            self.times[name] += time.perf_counter() - self.hook_starts.pop(name)
+
+        return [module.register_forward_pre_hook(pre_hook), module.register_forward_hook(hook)]
+
+    def count(self, name, n):
+        self.counts[name] += int(n)
+
+    def peak_memory_mb(self):
+        if self.device_type == "cuda":
+            return torch.cuda.max_memory_allocated() / 2**20
+        # peak resident set size of the process (in kilobytes on Linux)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+    def record(self, **fields):
+        """
+        Metrics of the step so far (phase times, counters and their rates per second, peak memory), after which the
+        timers and counters are reset for the next step.
+        """
+        elapsed = time.perf_counter() - self.start
+
+        record = {**fields, "step_seconds": round(elapsed, 4)}
+        record.update({f"{name}_seconds": round(t, 4) for name, t in self.times.items()})
+        for name, n in self.counts.items():
+            record[name] = n
+            record[f"{name}_per_second"] = round(n / elapsed, 2)
+        record["peak_memory_mb"] = round(self.peak_memory_mb(), 1)
+
+        self.reset()
+        return record
+
+
+def split_graph_phase(record):
+    """
+    Split the `graph` phase of a record (graph inputs to GAT outputs) into `graph_build` and the separately timed `gat_forward`.
+    """
+    if "graph_seconds" in record:
+        record["graph_build_seconds"] = round(record.pop("graph_seconds") - record.get("gat_forward_seconds", 0), 4)
+    return record
+
+
+def phase(metrics, name):
+    # time a phase if metrics are being recorded
+    return metrics.phase(name) if metrics is not None else nullcontext()
+
+
+class MetricsWriter():
+    """
+    Appends metrics records to a JSONL file (or discards them if `path` is None, e.g. on non-main processes).
+    """
+    def __init__(self, path):
+        self.f = open(path, "a") if path is not None else None
+
+    def write(self, record):
+        if self.f is not None:
+            self.f.write(json.dumps(record)+"\n")
+            self.f.flush()
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+
+
+def make_profiler(profile_steps, trace_dir):
+    """
+    Torch profiler tracing steps `start` to `end` (exclusive) of `profile_steps = [start, end]` to `trace_dir`
+    (viewable in TensorBoard), or None if no steps are given. `step()` should be called after every step.
+    """
+    if not profile_steps:
+        return None
+
+    start, end = profile_steps
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+
+    profiler = torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(wait=max(start - 1, 0), warmup=min(start, 1), active=end - start, repeat=1),
+        on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir),
+        record_shapes=True,
+        profile_memory=True,
+    )
+    profiler.start()
+    return profiler
@@ -2,6 +2,7 @@ import torch
 import dgl
 import random
 import pickle
+from functools import partial
 import torch.nn.functional as F
 from torch import nn 
 from torch.nn import CrossEntropyLoss
@@ -10,6 +11,9 @@ from transformers.modeling_outputs import BaseModelOutputWithPastAndCrossAttenti
 from transformers.models.led.modeling_led import LEDDecoder, LEDDecoderAttention, _expand_mask, _make_causal_mask, \
  ACT2FN, LEDEncoder , LEDSeq2SeqLMOutput, LEDSeq2SeqModelOutput, LEDEncoderBaseModelOutput, LEDLearnedPositionalEmbedding
 from typing import Optional, Tuple, Union
+from graph_store import GraphStore, compile_graph, get_store_dir, is_store, PE_DIM
+from graph_cache import GraphEmbeddingCache, gat_weights_hash, graph_store_hash, get_cache_path, is_cache, load_gat_weights, \
+ CACHE_DTYPES
 
 
 class GATModel(nn.Module):
@@ -34,65 +38,219 @@ class GATModel(nn.Module):
         return h
 
 class GraphEncoder():
-    def __init__(self, config):
-
-        self.graphs = {
-            "train": pickle.load(open(f"{config['graph_data_path']}/train_graphs_with_features.pkl", 'rb')),
-            "val": pickle.load(open(f"{config['graph_data_path']}/val_graphs_with_features.pkl", 'rb')),
-            "test": pickle.load(open(f"{config['graph_data_path']}/test_graphs_with_features.pkl", 'rb'))
-        }
-
-        self.GM = GATModel(config.GAT_dim, config.GAT_embedding_size, heads=[config['GAT_heads'],config['GAT_heads'],config['GAT_heads']])
+    def __init__(self, config, graph_precision="fp32"):
+
+        self.graph_data_path = config['graph_data_path']
+
+        # compiled, memory-mapped graph stores (see graph_store.py), loaded on first use of each split
+        self.stores = {}
+
+        self.embedding_size = config['GAT_embedding_size']
+        self.GM = GATModel(config['GAT_dim'], config['GAT_embedding_size'], heads=[config['GAT_heads'],config['GAT_heads'],config['GAT_heads']])
+
+        # offline GAT output caches (see graph_cache.py), only used if built with the current GAT weights, in the dtype
+        # of `graph_precision` (the graph precision of the PrecisionPolicy)
+        self.cache_dir = config.get('graph_cache_dir')
+        self.cache_dtype = CACHE_DTYPES[graph_precision]
+        self.caches = {}
+        if self.cache_dir is not None:
+            load_gat_weights(self.GM, self.cache_dir)
+
+    def get_cache(self, split):
+        if split not in self.caches:
+            self.caches[split] = None
+            if self.cache_dir is not None:
+                cache_path = get_cache_path(self.cache_dir, split, gat_weights_hash(self.GM), graph_store_hash(self.get_store(split)),
+                                            self.cache_dtype)
+                if is_cache(cache_path):
+                    self.caches[split] = GraphEmbeddingCache.load(cache_path)
+                else:
+                    print(f"No graph embedding cache found at {cache_path}, running the GAT for {split} graphs...")
+        return self.caches[split]
+
+    def get_store(self, split):
+        if split not in self.stores:
+            store_dir = get_store_dir(self.graph_data_path, split)
+            if is_store(store_dir):
+                self.stores[split] = GraphStore.load(store_dir)
+            else:
+                print(f"No compiled graph store found at {store_dir}, compiling {split} graphs in memory...")
+                graphs = pickle.load(open(f"{self.graph_data_path}/{split}_graphs_with_features.pkl", 'rb'))
+                self.stores[split] = GraphStore.from_graphs(graphs)
+        return self.stores[split]
 
     def get_graph(self, nodes, edges):
-        NODE = 'node'
-
-        # Build DGL graph
-        graph_data = {}
-
-        # Process edges
-        edgetype2tensor1, edgetype2tensor2, edge_types = {}, {}, set()
-        for n1, edge_type, n2 in edges:
-            node1_index = nodes.index(n1)
-            node2_index = nodes.index(n2)
-            if not edge_type in edgetype2tensor1: edgetype2tensor1[edge_type] = []
-            if not edge_type in edgetype2tensor2: edgetype2tensor2[edge_type] = []
-            edgetype2tensor1[edge_type].append(node1_index)
-            edgetype2tensor2[edge_type].append(node2_index)
-            edge_types.add(edge_type)
-
-        for edge_type in edge_types:
-            graph_data[(NODE, edge_type, NODE)] = (torch.tensor(edgetype2tensor1[edge_type]),
-                                                torch.tensor(edgetype2tensor2[edge_type]))
-
-        # Finalize the graph
-        G = dgl.heterograph(graph_data)
-        G = dgl.to_homogeneous(G)
-        G = dgl.add_self_loop(G) # etype="T186"
-
-        assert(G.number_of_nodes() == len(nodes))
-        
+        num_nodes, src, dst = compile_graph(nodes, edges)
+        G = dgl.graph((torch.from_numpy(src), torch.from_numpy(dst)), num_nodes=num_nodes)
         return G
 
 
+    def get_pos_embeddings(self, store, idx, G):
+        # precomputed random-walk positional encodings, computed on the fly for stores without them
+        pos_embeddings = store.get_pe(idx)
+        if pos_embeddings is None:
+            pos_embeddings = dgl.random_walk_pe(G, PE_DIM)
+        return pos_embeddings
+
     def forward(self, idx, split, device):
         
-        graph_info = self.graphs[split][idx]
-        nodes = graph_info['nodes']
-        edges = graph_info['edges']
-        node_embeddings = torch.tensor(graph_info['nfeatures']).to(device)
-        article_id = graph_info['id']
+        graph_embeddings, _ = self.encode([idx], split, device)
+
+        return graph_embeddings
+
+    def encode(self, idxs, split, device):
+        """
+        Encode the graphs of several articles with a single GAT pass over their batched (block-diagonal) graph,
+        or read their embeddings from the graph embedding cache if there is one.
+        Returns the node embeddings of all graphs, concatenated, and the number of nodes of each graph.
+        """
+        store = self.get_store(split)
+
+        cache = self.get_cache(split)
+        if cache is not None:
+            aids = [store.ids[int(idx)] for idx in idxs]
+            graph_embeddings = torch.cat([cache.get_embeddings(aid) for aid in aids]).to(device)
+            num_nodes = torch.tensor([cache.num_nodes(aid) for aid in aids])
+            return graph_embeddings, num_nodes
+
+        return self.encode_graphs([self.get_graph_inputs(idx, split) for idx in idxs], device)
+
+    def get_graph_inputs(self, idx, split):
+        """
+        DGL graph, node features and positional encodings of a graph in the store of `split`.
+        """
+        store = self.get_store(split)
+        G = store.get_graph(idx)
+        return G, store.get_features(idx), self.get_pos_embeddings(store, idx, G)
+
+    def get_graph_inputs_from_dict(self, graph):
+        """
+        DGL graph, node features and positional encodings of a graph given in the `*_graphs_with_features.pkl` format.
+        """
+        G = self.get_graph(graph['nodes'], graph['edges'])
+        node_embeddings = torch.tensor(graph['nfeatures'], dtype=torch.float32)
+        pos_embeddings = torch.tensor(graph['pe'], dtype=torch.float32) if 'pe' in graph else dgl.random_walk_pe(G, PE_DIM)
+        return G, node_embeddings, pos_embeddings
+
+    def encode_graphs(self, graph_inputs, device):
+        """
+        Run the GAT once over the batched (block-diagonal) graph of several (graph, features, positional encodings) inputs.
+        """
+        graphs, node_embeddings, pos_embeddings = zip(*graph_inputs)
 
         self.GM = self.GM.to(device)
-        G = self.get_graph(nodes, edges).to(device)
+        G = dgl.batch(graphs).to(device)
 
-        pos_embeddings = dgl.random_walk_pe(G, 16)
-        init_embeddings = torch.cat((pos_embeddings.to(device), node_embeddings), 1)
+        init_embeddings = torch.cat((torch.cat(pos_embeddings), torch.cat(node_embeddings)), 1).to(device)
         graph_embeddings = self.GM(G, init_embeddings)
 
-        return graph_embeddings
+        return graph_embeddings, G.batch_num_nodes()
+
+    def forward_batch(self, idxs, split, device, pad_to=None):
+        """
+        Encode the graphs of several articles (see `encode`).
+        Returns the node embeddings padded to *(batch, max_nodes, dim)*, or to `pad_to` rows if given, and the
+        corresponding node mask of size *(batch, max_nodes)* (1 for real nodes, 0 for padding).
+        """
+        graph_embeddings, num_nodes = self.encode(idxs, split, device)
+
+        return pad_graph_embeddings(graph_embeddings, num_nodes, pad_to)
+
+    def collate(self, idxs, split):
+        """
+        Assemble the GAT inputs of several articles into tensors, so that only the GAT forward is left for `forward_collated`.
+        Meant to run in DataLoader workers (see `utils.collate_elife_batch`). The graphs are merged into one block-diagonal
+        graph, given by its edges (`graph_src`, `graph_dst`) and its initial node embeddings (`graph_features`), or, if there
+        is a graph embedding cache, replaced by the cached GAT outputs (`graph_embeddings`).
+        """
+        store = self.get_store(split)
+
+        cache = self.get_cache(split)
+        if cache is not None:
+            aids = [store.ids[int(idx)] for idx in idxs]
+            return {
+                "graph_embeddings": torch.cat([cache.get_embeddings(aid) for aid in aids]),
+                "graph_num_nodes": torch.tensor([cache.num_nodes(aid) for aid in aids]),
+            }
+
+        all_src, all_dst, init_embeddings, num_nodes = [], [], [], []
+        offset = 0
+        for idx in idxs:
+            src, dst = store.get_edges(idx)
+            pos_embeddings = store.get_pe(idx)
+            if pos_embeddings is None:
+                pos_embeddings = dgl.random_walk_pe(store.get_graph(idx), PE_DIM)
+            all_src.append(src + offset)
+            all_dst.append(dst + offset)
+            init_embeddings.append(torch.cat((pos_embeddings, store.get_features(idx)), 1))
+            num_nodes.append(store.num_nodes(idx))
+            offset += num_nodes[-1]
+
+        return {
+            "graph_src": torch.cat(all_src),
+            "graph_dst": torch.cat(all_dst),
+            "graph_features": torch.cat(init_embeddings),
+            "graph_num_nodes": torch.tensor(num_nodes),
+        }
+
+    def get_collate(self, split):
+        """
+        Graph collate function for the DataLoader of `split`. The store and cache are loaded here, before the workers
+        are started, so that forked workers share them.
+        """
+        self.get_store(split)
+        self.get_cache(split)
+        return partial(self.collate, split=split)
+
+    def forward_collated(self, graph_batch, device, pad_to=None):
+        """
+        Run the GAT over graph inputs assembled by `collate` (or read their cached embeddings), with the same outputs as `forward_batch`.
+        """
+        num_nodes = graph_batch["graph_num_nodes"]
+
+        if "graph_embeddings" in graph_batch:
+            graph_embeddings = graph_batch["graph_embeddings"].to(device)
+        else:
+            self.GM = self.GM.to(device)
+            G = dgl.graph(
+                (graph_batch["graph_src"].to(device), graph_batch["graph_dst"].to(device)), num_nodes=int(num_nodes.sum())
+            )
+            graph_embeddings = self.GM(G, graph_batch["graph_features"].to(device))
+
+        return pad_graph_embeddings(graph_embeddings, num_nodes, pad_to)
+
+
+GRAPH_BATCH_KEYS = ["graph_src", "graph_dst", "graph_features", "graph_embeddings", "graph_num_nodes"]
+
+
+def pop_graph_batch(batch):
+    """
+    Remove the graph inputs added by `GraphEncoder.collate` from a batch, returning them.
+    """
+    return {k: batch.pop(k) for k in GRAPH_BATCH_KEYS if k in batch}
     
 
+def pad_graph_embeddings(graph_embeddings, num_nodes, pad_to=None):
+    """
+    Split the node embeddings of a batched graph per article and pad them into a *(batch, max_nodes, dim)* tensor.
+    Graphs with more than `pad_to` nodes are truncated.
+    """
+    num_nodes = num_nodes.to(graph_embeddings.device)
+    max_nodes = pad_to if pad_to is not None else int(num_nodes.max())
+
+    padded = nn.utils.rnn.pad_sequence(torch.split(graph_embeddings, num_nodes.tolist()), batch_first=True)
+    if padded.shape[1] < max_nodes:
+        padded = F.pad(padded, (0, 0, 0, max_nodes - padded.shape[1]), "constant", 0)
+    padded = padded[:, :max_nodes]
+
+    mask = (torch.arange(max_nodes, device=num_nodes.device)[None, :] < num_nodes[:, None]).long()
+
+    return padded, mask
+
+
+GRAPH_ATTENTION_STRATEGIES = ["full", "graph_to_text", "text_to_graph", "windowed"]
+
+
 def shift_tokens_right(input_ids: torch.Tensor, pad_token_id: int, decoder_start_token_id: int):
     """
     Shift input ids one token to the right.
@@ -145,6 +303,7 @@ class LEDKDecoderLayer(nn.Module):
         layer_head_mask: Optional[torch.Tensor] = None,
         cross_attn_layer_head_mask: Optional[torch.Tensor] = None,
         graph_hidden_states: Optional[torch.Tensor] = None,
+        graph_attention_mask: Optional[torch.Tensor] = None,
         past_key_value: Optional[Tuple[torch.Tensor]] = None,
         output_attentions: Optional[bool] = False,
         use_cache: Optional[bool] = True,
@@ -162,6 +321,10 @@ class LEDKDecoderLayer(nn.Module):
                 *(decoder_attention_heads,)*.
             cross_attn_layer_head_mask (`torch.FloatTensor`): mask for encoder attention heads in a given layer of
                 size *(decoder_attention_heads,)*.
+            graph_hidden_states (`torch.FloatTensor`):
+                graph attention input to the layer of shape *(batch, num_nodes, embed_dim)*
+            graph_attention_mask (`torch.FloatTensor`): graph attention mask of size
+                *(batch, 1, tgt_len, num_nodes)* where padding nodes are indicated by very large negative values.
             past_key_value (`Tuple(torch.FloatTensor)`): cached past key and value projection states
             output_attentions (`bool`): Whether the base _outputs attentions.
                 This requires the attentions tensor to be reshaped in this function.
@@ -190,7 +353,7 @@ class LEDKDecoderLayer(nn.Module):
             residual = hidden_states
 
             # cross_attn cached key/values tuple is at positions 3,4 of present_key_value tuple
-            cross_attn_past_key_value = past_key_value[-2:] if past_key_value is not None else None
+            cross_attn_past_key_value = past_key_value[2:4] if past_key_value is not None else None
             hidden_states, cross_attn_weights, cross_attn_present_key_value = self.encoder_attn(
                 hidden_states=hidden_states,
                 key_value_states=encoder_hidden_states,
@@ -206,21 +369,23 @@ class LEDKDecoderLayer(nn.Module):
             # add cross-attn to positions 3,4 of present_key_value tuple
             present_key_value = present_key_value + cross_attn_present_key_value
 
-
-            # Graph Attention Block
+        # Graph Attention Block
+        if encoder_hidden_states is not None and graph_hidden_states is not None:
             residual = hidden_states
 
-            # cross_attn cached key/values tuple is at positions 3,4 of present_key_value tuple
-            graph_attn_past_key_value = past_key_value[-2:] if past_key_value is not None else None
-            hidden_states, graph_attn_weights, graph_attn_present_key_value = self.encoder_attn(
+            # graph_attn cached key/values tuple is at positions 5,6 of present_key_value tuple
+            graph_attn_past_key_value = past_key_value[4:6] if past_key_value is not None else None
+            hidden_states, graph_attn_present_key_value = self.graph_attn(
                 hidden_states=hidden_states,
-                key_value_states=graph_hidden_states,
+                graph_hidden_states=graph_hidden_states,
+                attention_mask=graph_attention_mask,
+                past_key_value=graph_attn_past_key_value,
             )
             hidden_states = nn.functional.dropout(hidden_states, p=self.dropout, training=self.training)
             hidden_states = residual + 0.5*hidden_states
             hidden_states = self.encoder_attn_layer_norm(hidden_states)
 
-            # add cross-attn to positions 3,4 of present_key_value tuple
+            # add graph-attn to positions 5,6 of present_key_value tuple
             present_key_value = present_key_value + graph_attn_present_key_value
 
 
@@ -239,6 +404,56 @@ class LEDKDecoderLayer(nn.Module):
             outputs += (present_key_value,)
 
         return outputs
+
+    def graph_attn(
+        self,
+        hidden_states: torch.Tensor,
+        graph_hidden_states: Optional[torch.Tensor] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        past_key_value: Optional[Tuple[torch.Tensor]] = None,
+    ):
+        """
+        Attention over the graph memory, using the projections of `encoder_attn`.
+
+        Graph keys/values are projected once per article, *(graph_batch, heads, num_nodes, head_dim)*, and reused from
+        `past_key_value` at every later decoding step. They are not expanded for beam search: when `hidden_states`
+        holds several (beam) rows per article, the queries of each article are grouped and attend to the same keys/values.
+        `attention_mask` is the expanded graph attention mask of size *(graph_batch, 1, tgt_len, num_nodes)*.
+        """
+        attn = self.encoder_attn
+        bsz, tgt_len, embed_dim = hidden_states.size()
+
+        if past_key_value is not None:
+            key_states, value_states = past_key_value
+        else:
+            graph_bsz = graph_hidden_states.size(0)
+            key_states = attn._shape(attn.k_proj(graph_hidden_states), -1, graph_bsz)
+            value_states = attn._shape(attn.v_proj(graph_hidden_states), -1, graph_bsz)
+
+        graph_bsz = key_states.size(0)
+        num_beams = bsz // graph_bsz
+
+        # [bsz, tgt_len, embed_dim] -> [graph_bsz, heads, num_beams * tgt_len, head_dim]
+        query_states = attn.q_proj(hidden_states) * attn.scaling
+        query_states = query_states.view(graph_bsz, num_beams, tgt_len, attn.num_heads, attn.head_dim)
+        query_states = query_states.permute(0, 3, 1, 2, 4).reshape(graph_bsz, attn.num_heads, num_beams * tgt_len, attn.head_dim)
+
+        attn_weights = torch.matmul(query_states, key_states.transpose(2, 3))
+
+        if attention_mask is not None:
+            # padding nodes are the same for every query position
+            attn_weights = attn_weights + attention_mask[:, :, :1]
+
+        attn_weights = nn.functional.softmax(attn_weights, dim=-1)
+        attn_probs = nn.functional.dropout(attn_weights, p=attn.dropout, training=self.training)
+        attn_output = torch.matmul(attn_probs, value_states)
+
+        # [graph_bsz, heads, num_beams * tgt_len, head_dim] -> [bsz, tgt_len, embed_dim]
+        attn_output = attn_output.view(graph_bsz, attn.num_heads, num_beams, tgt_len, attn.head_dim)
+        attn_output = attn_output.permute(0, 2, 3, 1, 4).reshape(bsz, tgt_len, embed_dim)
+        attn_output = attn.out_proj(attn_output)
+
+        return attn_output, (key_states, value_states)
     
 
 
@@ -290,6 +505,7 @@ class LEDKDecoder(LEDPreTrainedModel):
         output_hidden_states=None,
         return_dict=None,
         graph_hidden_states=None,
+        graph_attention_mask=None,
     ):
         r"""
         Args:
@@ -364,6 +580,14 @@ class LEDKDecoder(LEDPreTrainedModel):
                 for more detail.
             return_dict (`bool`, *optional*):
                 Whether or not to return a [`~utils.ModelOutput`] instead of a plain tuple.
+            graph_hidden_states (`torch.FloatTensor` of shape `(batch_size, num_nodes, hidden_size)`, *optional*):
+                Graph encoder outputs, padded to the largest graph in the batch. Used in the graph attention of the
+                decoder.
+            graph_attention_mask (`torch.LongTensor` of shape `(batch_size, num_nodes)`, *optional*):
+                Mask to avoid performing graph attention on padding nodes. Mask values selected in `[0, 1]`:
+
+                - 1 for nodes that are **not masked**,
+                - 0 for nodes that are **masked**.
         """
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
@@ -408,6 +632,11 @@ class LEDKDecoder(LEDPreTrainedModel):
             # [bsz, seq_len] -> [bsz, 1, tgt_seq_len, src_seq_len]
             encoder_attention_mask = _expand_mask(encoder_attention_mask, inputs_embeds.dtype, tgt_len=input_shape[-1])
 
+        # expand graph attention mask
+        if graph_hidden_states is not None and graph_attention_mask is not None:
+            # [bsz, num_nodes] -> [bsz, 1, tgt_seq_len, num_nodes]
+            graph_attention_mask = _expand_mask(graph_attention_mask, inputs_embeds.dtype, tgt_len=input_shape[-1])
+
         # embed positions
         positions = self.embed_positions(input_shape, past_key_values_length)
 
@@ -465,6 +694,7 @@ class LEDKDecoder(LEDPreTrainedModel):
                     head_mask[idx] if head_mask is not None else None,
                     cross_attn_head_mask[idx] if cross_attn_head_mask is not None else None,
                     graph_hidden_states,
+                    graph_attention_mask,
                     None,
                 )
             else:
@@ -478,6 +708,7 @@ class LEDKDecoder(LEDPreTrainedModel):
                         cross_attn_head_mask[idx] if cross_attn_head_mask is not None else None
                     ),
                     graph_hidden_states=graph_hidden_states,
+                    graph_attention_mask=graph_attention_mask,
                     past_key_value=past_key_value,
                     output_attentions=output_attentions,
                     use_cache=use_cache,
@@ -579,7 +810,8 @@ class LEDKGraphEncoderLayer(nn.Module):
 class LEDKModel(LEDPreTrainedModel):
     _keys_to_ignore_on_load_missing = ["decoder.embed_tokens.weight", "encoder.embed_tokens.weight"]
 
-    def __init__(self, config: LEDConfig, is_merge_encoders=False, is_graph_decoder=False, multiplier=0.25):
+    def __init__(self, config: LEDConfig, is_merge_encoders=False, is_graph_decoder=False, multiplier=0.25,
+                 graph_attention_strategy="full", graph_attention_window=512):
         super().__init__(config)
 
         padding_idx, vocab_size = config.pad_token_id, config.vocab_size
@@ -607,6 +839,11 @@ class LEDKModel(LEDPreTrainedModel):
         self.graph_multiplier = multiplier
         self.graph_final_layer_norm = nn.LayerNorm(config.d_model)
 
+        if graph_attention_strategy not in GRAPH_ATTENTION_STRATEGIES:
+            raise ValueError(f"graph_attention_strategy should be one of {GRAPH_ATTENTION_STRATEGIES}, got {graph_attention_strategy}")
+        self.graph_attention_strategy = graph_attention_strategy
+        self.graph_attention_window = graph_attention_window
+
  
         print("is_graph_decoder ", is_graph_decoder)
         print("is_merge_encoders ", is_merge_encoders)
@@ -628,6 +865,79 @@ class LEDKModel(LEDPreTrainedModel):
     def get_decoder(self):
         return self.decoder
 
+    def merged_graph_attention(self, hidden_states, attention_mask, text_len):
+        """
+        Multi-head attention over the merged text and graph positions, using the weights of `graph_attention` with
+        the fused `scaled_dot_product_attention` kernel. `graph_attention_strategy` selects which positions attend:
+
+        - "full": every position attends to every (non-padding) position
+        - "graph_to_text": only graph positions attend (to all positions), text positions get no attention output
+        - "text_to_graph": every position attends to the graph positions only
+        - "windowed": text positions attend to their own block of `graph_attention_window` text positions and to all
+          graph positions, graph positions attend to all positions
+
+        A boolean mask restricts `scaled_dot_product_attention` to its math kernel (as of torch 2.0), which holds the
+        full attention matrix in memory, so masks are only passed when some positions are padding.
+        """
+        mha = self.graph_attention
+        bsz, seq_len, embed_dim = hidden_states.size()
+        num_heads = mha.num_heads
+        head_dim = embed_dim // num_heads
+        dropout_p = mha.dropout if self.training else 0.0
+
+        # [bsz, seq_len, embed_dim] -> [bsz, heads, seq_len, head_dim]
+        qkv = nn.functional.linear(hidden_states, mha.in_proj_weight, mha.in_proj_bias)
+        query, key, value = [x.view(bsz, seq_len, num_heads, head_dim).transpose(1, 2) for x in qkv.chunk(3, dim=-1)]
+
+        # [bsz, 1, 1, seq_len], True for positions that can be attended to
+        key_mask = (attention_mask != 0)[:, None, None, :]
+        # without padding, no mask is needed and the fused kernels can be used
+        all_mask = None if key_mask.all() else key_mask
+        graph_key_mask = None if key_mask[..., text_len:].all() else key_mask[..., text_len:]
+
+        if self.graph_attention_strategy == "full":
+            attn_output = F.scaled_dot_product_attention(query, key, value, attn_mask=all_mask, dropout_p=dropout_p)
+
+        elif self.graph_attention_strategy == "graph_to_text":
+            graph_output = F.scaled_dot_product_attention(query[:, :, text_len:], key, value, attn_mask=all_mask, dropout_p=dropout_p)
+            attn_output = torch.cat((torch.zeros_like(query[:, :, :text_len]), graph_output), 2)
+
+        elif self.graph_attention_strategy == "text_to_graph":
+            attn_output = F.scaled_dot_product_attention(
+                query, key[:, :, text_len:], value[:, :, text_len:], attn_mask=graph_key_mask, dropout_p=dropout_p
+            )
+
+        else:  # windowed
+            window = self.graph_attention_window
+            num_blocks = -(-text_len // window)
+            padding_len = num_blocks * window - text_len
+            graph_len = seq_len - text_len
+
+            def to_blocks(x):
+                # [bsz, heads, text_len, head_dim] -> [bsz, heads, num_blocks, window, head_dim]
+                x = F.pad(x[:, :, :text_len], (0, 0, 0, padding_len))
+                return x.view(bsz, num_heads, num_blocks, window, head_dim)
+
+            def with_graph(x):
+                # append the graph positions to the keys/values of every block
+                graph_x = x[:, :, None, text_len:].expand(-1, -1, num_blocks, -1, -1)
+                return torch.cat((to_blocks(x), graph_x), 3)
+
+            text_mask = F.pad(key_mask[:, 0, 0, :text_len], (0, padding_len), value=False).view(bsz, 1, num_blocks, 1, window)
+            graph_mask = key_mask[:, 0, 0, text_len:].view(bsz, 1, 1, 1, graph_len).expand(-1, -1, num_blocks, -1, -1)
+            block_mask = torch.cat((text_mask, graph_mask), -1)
+
+            text_output = F.scaled_dot_product_attention(
+                to_blocks(query), with_graph(key), with_graph(value), attn_mask=block_mask, dropout_p=dropout_p
+            )
+            text_output = text_output.view(bsz, num_heads, num_blocks * window, head_dim)[:, :, :text_len]
+            graph_output = F.scaled_dot_product_attention(query[:, :, text_len:], key, value, attn_mask=all_mask, dropout_p=dropout_p)
+            attn_output = torch.cat((text_output, graph_output), 2)
+
+        # [bsz, heads, seq_len, head_dim] -> [bsz, seq_len, embed_dim]
+        attn_output = attn_output.transpose(1, 2).reshape(bsz, seq_len, embed_dim)
+        return mha.out_proj(attn_output)
+
     def forward(
         self,
         input_ids: Optional[torch.LongTensor] = None,
@@ -647,6 +957,7 @@ class LEDKModel(LEDPreTrainedModel):
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
         graph_encoder_outputs = None,
+        graph_attention_mask: Optional[torch.LongTensor] = None,
     ) -> Union[Tuple[torch.Tensor], LEDSeq2SeqModelOutput]:
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
@@ -691,11 +1002,26 @@ class LEDKModel(LEDPreTrainedModel):
 
         # Document Embedding Enhancement Method
         if graph_encoder_outputs is not None and self.is_merge_encoders:
+
+            # graph memory is not expanded for beam search (see `LEDKDecoderLayer.graph_attn`), but is merged per beam here
+            num_beams = encoder_outputs['last_hidden_state'].size()[0] // graph_encoder_outputs.size()[0]
+            if num_beams > 1:
+                graph_encoder_outputs = graph_encoder_outputs.repeat_interleave(num_beams, dim=0)
+                if graph_attention_mask is not None:
+                    graph_attention_mask = graph_attention_mask.repeat_interleave(num_beams, dim=0)
               
             concat = torch.cat((encoder_outputs['last_hidden_state'], graph_encoder_outputs), 1)
+
+            # attention mask over the merged text and graph positions
+            bsz, text_len, graph_len = concat.size()[0], encoder_outputs['last_hidden_state'].size()[1], graph_encoder_outputs.size()[1]
+            if attention_mask is None:
+                attention_mask = torch.ones(bsz, text_len, dtype=torch.long, device=concat.device)
+            if graph_attention_mask is None:
+                graph_attention_mask = torch.ones(bsz, graph_len, dtype=torch.long, device=concat.device)
+            attention_mask = torch.cat((attention_mask, graph_attention_mask.to(attention_mask.dtype)), 1)
+
             residual = concat
-            attn_output, attn_output_weights = self.graph_attention(concat, concat, concat)
-            hidden_states = attn_output[0]
+            hidden_states = self.merged_graph_attention(concat, attention_mask, text_len)
             hidden_states = nn.functional.dropout(hidden_states, p=self.graph_dropout, training=self.training)
             hidden_states = residual + hidden_states
             hidden_states = self.graph_attn_layer_norm(hidden_states)
@@ -715,10 +1041,6 @@ class LEDKModel(LEDPreTrainedModel):
                 hidden_states = torch.clamp(hidden_states, min=-clamp_value, max=clamp_value)
             
             hidden_states = (1 - self.graph_multiplier)*concat + self.graph_multiplier*hidden_states
-            if attention_mask.size()[-1] != hidden_states.size()[-1]:
-                x1 = attention_mask.size()[0]
-                device = attention_mask.get_device()
-                attention_mask = torch.cat((attention_mask, torch.ones(x1, 1024).to(device)), 1)
         else:
             hidden_states = encoder_outputs[0]
 
@@ -738,6 +1060,7 @@ class LEDKModel(LEDPreTrainedModel):
                 output_hidden_states=output_hidden_states,
                 return_dict=return_dict,
                 graph_hidden_states = graph_encoder_outputs,
+                graph_attention_mask = graph_attention_mask,
             )
         else:
             decoder_outputs = self.decoder(
@@ -784,9 +1107,13 @@ class LEDKForConditionalGeneration(LEDPreTrainedModel):
         "encoder.embed_tokens.weight",
     ]
 
-    def __init__(self, config: LEDConfig, is_merge_encoders=False, is_graph_decoder=False, multiplier=0.25):
+    def __init__(self, config: LEDConfig, is_merge_encoders=False, is_graph_decoder=False, multiplier=0.25,
+                 graph_attention_strategy="full", graph_attention_window=512):
         super().__init__(config)
-        self.led = LEDKModel(config, is_merge_encoders=is_merge_encoders, is_graph_decoder=is_graph_decoder, multiplier=multiplier)
+        self.led = LEDKModel(
+            config, is_merge_encoders=is_merge_encoders, is_graph_decoder=is_graph_decoder, multiplier=multiplier,
+            graph_attention_strategy=graph_attention_strategy, graph_attention_window=graph_attention_window,
+        )
         self.register_buffer("final_logits_bias", torch.zeros((1, self.led.shared.num_embeddings)))
         self.lm_head = nn.Linear(config.d_model, self.led.shared.num_embeddings, bias=False)
 
@@ -839,6 +1166,7 @@ class LEDKForConditionalGeneration(LEDPreTrainedModel):
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
         graph_encoder_outputs = None,
+        graph_attention_mask: Optional[torch.LongTensor] = None,
     ) -> Union[Tuple[torch.Tensor], LEDSeq2SeqLMOutput]:
         r"""
         labels (`torch.LongTensor` of shape `(batch_size, sequence_length)`, *optional*):
@@ -885,6 +1213,7 @@ class LEDKForConditionalGeneration(LEDPreTrainedModel):
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
             graph_encoder_outputs = graph_encoder_outputs,
+            graph_attention_mask = graph_attention_mask,
         )
         
         lm_logits = self.lm_head(outputs[0]) + self.final_logits_bias
@@ -923,6 +1252,7 @@ class LEDKForConditionalGeneration(LEDPreTrainedModel):
         use_cache=None,
         encoder_outputs=None,
         graph_encoder_outputs = None,
+        graph_attention_mask = None,
         **kwargs,
     ):
        
@@ -942,16 +1272,27 @@ class LEDKForConditionalGeneration(LEDPreTrainedModel):
             "cross_attn_head_mask": cross_attn_head_mask,
             "use_cache": use_cache,  # change this to avoid caching (presumably for debugging)
             "graph_encoder_outputs": graph_encoder_outputs,
+            "graph_attention_mask": graph_attention_mask,
         }
 
     def prepare_decoder_input_ids_from_labels(self, labels: torch.Tensor):
         return shift_tokens_right(labels, self.config.pad_token_id, self.config.decoder_start_token_id)
 
+    @staticmethod
+    def _expand_inputs_for_generation(expand_size=1, is_encoder_decoder=False, input_ids=None, **model_kwargs):
+        # graph memory is shared by all beams of an article (see `LEDKDecoderLayer.graph_attn`), so it is not expanded
+        graph_kwargs = {k: model_kwargs.pop(k) for k in ["graph_encoder_outputs", "graph_attention_mask"] if k in model_kwargs}
+        input_ids, model_kwargs = LEDPreTrainedModel._expand_inputs_for_generation(
+            expand_size=expand_size, is_encoder_decoder=is_encoder_decoder, input_ids=input_ids, **model_kwargs
+        )
+        model_kwargs.update(graph_kwargs)
+        return input_ids, model_kwargs
+
     @staticmethod
     def _reorder_cache(past_key_values, beam_idx):
         reordered_past = ()
         for layer_past in past_key_values:
-            # cached cross_attention states don't have to be reordered -> they are always the same
+            # cached cross_attention and graph attention states don't have to be reordered -> they are always the same
             reordered_past += (
                 tuple(past_state.index_select(0, beam_idx) for past_state in layer_past[:2]) + layer_past[2:],
             )
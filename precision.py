@@ -0,0 +1,69 @@
+import contextlib
+import torch
+
+
+DTYPES = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+# precision of each component per device type, overridden by the `precision` entry of the config:
+#   model: dtype the LEDK weights are loaded in for inference (training always keeps float32 weights)
+#   graph: dtype the GAT outputs are handed to the LEDK model in
+#   autocast: mixed precision dtype for training (and inference, if set), or None
+DEFAULT_PRECISION = {
+    "cuda": {"model": "fp16", "graph": "fp16", "autocast": None},
+    # fp16 matmuls are much slower than fp32 (or bf16) on CPU
+    "cpu": {"model": "fp32", "graph": "fp32", "autocast": None},
+}
+
+
+class PrecisionPolicy():
+    """
+    Dtypes used for the LEDK model and the graph embeddings on one device, and the optional autocast dtype.
+    """
+    def __init__(self, device, model="fp32", graph="fp32", autocast=None):
+        self.device_type = torch.device(device).type
+
+        for name in [model, graph, autocast]:
+            if name is not None and name not in DTYPES:
+                raise ValueError(f"precision should be one of {list(DTYPES)}, got {name}")
+        if autocast == "fp32":
+            raise ValueError("autocast precision should be bf16 or fp16 (or None to disable autocast)")
+        if self.device_type == "cpu" and autocast == "fp16":
+            # CPU autocast only supports bf16, and fp16 would otherwise fail deep inside the first forward pass
+            raise ValueError("fp16 autocast is not supported on CPU, use bf16 (or None to disable autocast)")
+        if self.device_type == "cuda" and "bf16" in [model, graph, autocast] and not torch.cuda.is_bf16_supported():
+            raise ValueError("bf16 is not supported on this GPU, use fp16 or fp32 instead")
+
+        self.model = model
+        self.graph = graph
+        self.autocast_precision = autocast
+
+    @classmethod
+    def from_config(cls, config, device):
+        device_type = torch.device(device).type
+        precision = dict(DEFAULT_PRECISION.get(device_type, DEFAULT_PRECISION["cpu"]))
+        precision.update(config.get("precision", {}).get(device_type, {}))
+        return cls(device, **precision)
+
+    @property
+    def model_dtype(self):
+        return DTYPES[self.model]
+
+    @property
+    def graph_dtype(self):
+        return DTYPES[self.graph]
+
+    @property
+    def mixed_precision(self):
+        # `mixed_precision` argument of accelerate's Accelerator
+        return self.autocast_precision or "no"
+
+    def cast_graph(self, graph_embeddings):
+        return graph_embeddings.to(self.graph_dtype)
+
+    def autocast(self):
+        if self.autocast_precision is None:
+            return contextlib.nullcontext()
+        return torch.autocast(self.device_type, dtype=DTYPES[self.autocast_precision])
+
+    def __repr__(self):
+        return f"PrecisionPolicy({self.device_type}: model={self.model}, graph={self.graph}, autocast={self.autocast_precision})"
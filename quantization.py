@@ -0,0 +1,32 @@
+import torch
+from torch import nn
+
+
+# submodules of LEDKForConditionalGeneration whose nn.Linear layers are quantised. The LM head (tied to the
+# shared embeddings) and the merged graph attention (which uses its projection weights directly) stay in fp32.
+QUANTIZED_MODULES = {"led.encoder", "led.decoder.layers", "led.graph_fc1", "led.graph_fc2"}
+
+
+def quantize_model(model):
+    """
+    Copy of a float32 LEDK model with the nn.Linear layers of the LED encoder, the decoder layers and the graph FFN
+    dynamically quantised to int8 (weights stored as int8, activations quantised on the fly). CPU only.
+    """
+    return torch.quantization.quantize_dynamic(model, QUANTIZED_MODULES, dtype=torch.qint8)
+
+
+def quantize_gat(GM):
+    """
+    Copy of a float32 GAT with the linear projections of its GATConv layers dynamically quantised to int8.
+    """
+    return torch.quantization.quantize_dynamic(GM, {nn.Linear}, dtype=torch.qint8)
+
+
+def quantize_graph_encoder(graph_encoder):
+    """
+    Quantise the GAT of a GraphEncoder in place. Graph encoders reading from a graph embedding cache are left
+    unchanged, as they do not run the GAT and the cache is keyed by the float32 weights.
+    """
+    if graph_encoder.cache_dir is None:
+        graph_encoder.GM = quantize_gat(graph_encoder.GM)
+    return graph_encoder
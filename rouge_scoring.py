@@ -0,0 +1,211 @@
+import json
+import argparse
+import numpy as np
+import nltk
+from multiprocessing import Pool
+from nltk.stem import porter
+from rouge_score import rouge_scorer, scoring, tokenize
+
+
+ROUGE_TYPES = ["rouge1", "rouge2", "rougeL", "rougeLsum"]
+
+
+class CachedStemmer():
+    """
+    Porter stemmer (as used by rouge_score) that remembers the stem of every word it has seen.
+    """
+    def __init__(self):
+        self.stemmer = porter.PorterStemmer()
+        self.stems = {}
+
+    def stem(self, word):
+        if word not in self.stems:
+            self.stems[word] = self.stemmer.stem(word)
+        return self.stems[word]
+
+
+def tokenize_summary(text, stemmer=None):
+    """
+    Tokens of a summary as tokenized by rouge_score, both overall and per sentence (for rougeLsum).
+    """
+    # rougeLsum expects newline after each sentence
+    sents = [sent for sent in nltk.sent_tokenize(text.strip()) if sent]
+    return {
+        "tokens": tokenize.tokenize("\n".join(sents), stemmer),
+        "sent_tokens": [tokenize.tokenize(sent, stemmer) for sent in sents],
+        "ngrams": {},
+    }
+
+
+def get_ngrams(tokenized, n):
+    if n not in tokenized["ngrams"]:
+        tokenized["ngrams"][n] = rouge_scorer._create_ngrams(tokenized["tokens"], n)
+    return tokenized["ngrams"][n]
+
+
+def score_tokenized(reference, prediction, rouge_types=ROUGE_TYPES):
+    """
+    ROUGE scores of a tokenized prediction against a tokenized reference, computed as by `rouge_scorer.RougeScorer`.
+    """
+    scores = {}
+    for rouge_type in rouge_types:
+        if rouge_type == "rougeL":
+            scores[rouge_type] = rouge_scorer._score_lcs(reference["tokens"], prediction["tokens"])
+        elif rouge_type == "rougeLsum":
+            scores[rouge_type] = rouge_scorer._summary_level_lcs(reference["sent_tokens"], prediction["sent_tokens"])
+        else:
+            n = int(rouge_type[5:])
+            scores[rouge_type] = rouge_scorer._score_ngrams(get_ngrams(reference, n), get_ngrams(prediction, n))
+    return scores
+
+
+# state of each scoring process, set by `init_worker`
+worker_state = {}
+
+
+def init_worker(use_stemmer=True, rouge_types=ROUGE_TYPES):
+    worker_state["stemmer"] = CachedStemmer() if use_stemmer else None
+    worker_state["rouge_types"] = rouge_types
+    # tokenized references, reused whenever the same reference is scored again (e.g. at every validation)
+    worker_state["references"] = {}
+
+
+def get_tokenized_reference(reference):
+    references = worker_state["references"]
+    if reference not in references:
+        references[reference] = tokenize_summary(reference, worker_state["stemmer"])
+    return references[reference]
+
+
+def score_documents(documents):
+    """
+    Score a list of (key, prediction, reference) triples, returning (key, scores) pairs.
+    """
+    return [
+        (key, score_tokenized(get_tokenized_reference(reference), tokenize_summary(prediction, worker_state["stemmer"]),
+                              worker_state["rouge_types"]))
+        for key, prediction, reference in documents
+    ]
+
+
+class IncrementalRouge():
+    """
+    Per-document ROUGE, scored in a pool of `num_workers` processes (or in this process if 0) as soon as predictions
+    are added. The aggregate over the documents scored so far is available at any time.
+    """
+    def __init__(self, num_workers=None, use_stemmer=True, rouge_types=ROUGE_TYPES, chunk_size=8):
+        self.rouge_types = rouge_types
+        self.chunk_size = chunk_size
+
+        self.pool = None
+        if num_workers == 0:
+            init_worker(use_stemmer, rouge_types)
+        else:
+            self.pool = Pool(num_workers, initializer=init_worker, initargs=(use_stemmer, rouge_types))
+
+        self.reset()
+
+    def reset(self):
+        self.scores = {}
+        self.pending = []
+        self.num_added = 0
+
+    def add(self, predictions, references, keys=None):
+        """
+        Queue documents for scoring. Keys identify the documents in `document_scores` (by default, the order they were added in).
+        """
+        if keys is None:
+            keys = range(self.num_added, self.num_added + len(predictions))
+        documents = list(zip(keys, predictions, references))
+        self.num_added += len(documents)
+
+        for start in range(0, len(documents), self.chunk_size):
+            chunk = documents[start:start+self.chunk_size]
+            if self.pool is None:
+                self.scores.update(score_documents(chunk))
+            else:
+                self.pending.append(self.pool.apply_async(score_documents, (chunk,)))
+
+    def add_batch(self, predictions, references):
+        # same interface as `evaluate` metrics
+        self.add(predictions, references)
+
+    def collect(self, wait=False):
+        pending = []
+        for result in self.pending:
+            if wait or result.ready():
+                self.scores.update(result.get())
+            else:
+                pending.append(result)
+        self.pending = pending
+
+    def aggregate(self, wait=True, bootstrap=False):
+        """
+        F-measure (x100) of each ROUGE type, averaged over the documents scored so far (all added documents if `wait`).
+        With `bootstrap`, the mid estimate of rouge_score's BootstrapAggregator (as reported by `evaluate`) is used.
+        """
+        self.collect(wait)
+        if not self.scores:
+            return {}
+
+        if bootstrap:
+            aggregator = scoring.BootstrapAggregator()
+            for scores in self.scores.values():
+                aggregator.add_scores(scores)
+            result = {k: v.mid.fmeasure for k, v in aggregator.aggregate().items()}
+        else:
+            result = {k: np.mean([scores[k].fmeasure for scores in self.scores.values()]) for k in self.rouge_types}
+
+        return {k: round(float(v) * 100, 4) for k, v in result.items()}
+
+    def compute(self, bootstrap=False):
+        """
+        Aggregate over all added documents, after which the scorer is reset (as `evaluate` metrics are).
+        """
+        result = self.aggregate(wait=True, bootstrap=bootstrap)
+        self.reset()
+        return result
+
+    def document_scores(self):
+        self.collect(wait=True)
+        return {key: {k: round(v.fmeasure * 100, 4) for k, v in scores.items()} for key, scores in sorted(self.scores.items())}
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("preds_path", help="file with one predicted summary per line, in the order of the split")
+    parser.add_argument("--split", default="test", help="eLife split the predictions were generated for")
+    parser.add_argument("--num_workers", type=int, default=None, help="scoring processes (default: one per core)")
+    parser.add_argument("--bootstrap", action="store_true", help="report bootstrap mid estimates rather than means")
+    parser.add_argument("--per_document", default=None, help="JSONL file to write the scores of each document to")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from utils import iter_articles
+
+    args = parse_args()
+
+    scorer = IncrementalRouge(num_workers=args.num_workers)
+
+    with open(args.preds_path, "r") as f:
+        preds = [line.rstrip("\n") for line in f]
+    refs = [inst['summary'] for inst in iter_articles("elife", args.split, columns=("summary",))]
+    if len(preds) != len(refs):
+        raise ValueError(f"{args.preds_path} has {len(preds)} predictions, but the {args.split} split has {len(refs)} articles")
+
+    scorer.add(preds, refs)
+
+    if args.per_document is not None:
+        with open(args.per_document, "w") as f:
+            for idx, scores in scorer.document_scores().items():
+                f.write(json.dumps({"idx": idx, **scores})+"\n")
+
+    print(json.dumps(scorer.aggregate(bootstrap=args.bootstrap), indent=2))
+    scorer.close()
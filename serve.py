@@ -0,0 +1,198 @@
+import time
+import json
+import queue
+import argparse
+import threading
+import torch
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from transformers import AutoTokenizer
+from model import GraphEncoder, pad_graph_embeddings
+from generate import load_model, decode_batch
+from precision import PrecisionPolicy
+from utils import iter_indexed_articles, load_train_config
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_dir", help="directory of the trained model")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max_batch_size", type=int, default=8)
+    parser.add_argument("--max_wait_ms", type=int, default=200,
+                        help="how long a request may wait for others to be batched with it")
+    parser.add_argument("--bucket_size", type=int, default=1024,
+                        help="requests are only batched with others of the same input length bucket (in tokens)")
+    return parser.parse_args()
+
+
+class SummarisationRequest():
+    def __init__(self, article, graph_inputs):
+        self.article = article
+        self.input_ids = None
+        self.graph_inputs = graph_inputs
+        self.arrival = time.monotonic()
+        self.future = Future()
+
+
+class DynamicBatcher():
+    """
+    Groups concurrent summarisation requests into batches of similar input length. A batch is run as soon as it is
+    full, or once its oldest request has waited `max_wait_ms`. Articles are tokenized by the batcher's own thread,
+    as fast tokenizers cannot be used from several threads at once.
+    """
+    def __init__(self, model, tokenizer, graph_encoder, device, precision, max_length, max_batch_size=8, max_wait_ms=200,
+                 bucket_size=1024):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.graph_encoder = graph_encoder
+        self.device = device
+        self.precision = precision
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.bucket_size = bucket_size
+
+        self.requests = queue.Queue()
+        self.buckets = {}
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, article, graph_inputs):
+        request = SummarisationRequest(article, graph_inputs)
+        self.requests.put(request)
+        return request.future
+
+    def get_bucket(self, request):
+        return len(request.input_ids) // self.bucket_size
+
+    def next_batch(self):
+        """
+        Wait for the next batch to be ready and remove it from its bucket.
+        """
+        while True:
+            # the bucket holding the oldest request is the first to reach its deadline
+            oldest = min(self.buckets.values(), key=lambda b: b[0].arrival, default=None)
+            timeout = None if oldest is None else max(0, oldest[0].arrival + self.max_wait - time.monotonic())
+
+            try:
+                request = self.requests.get(timeout=timeout)
+                try:
+                    request.input_ids = self.tokenizer(request.article, truncation=True, max_length=self.max_length)["input_ids"]
+                except Exception as e:
+                    request.future.set_exception(e)
+                    continue
+                self.buckets.setdefault(self.get_bucket(request), []).append(request)
+            except queue.Empty:
+                pass
+
+            for bucket, requests in self.buckets.items():
+                is_full = len(requests) >= self.max_batch_size
+                is_due = time.monotonic() >= requests[0].arrival + self.max_wait
+                if is_full or is_due:
+                    batch = requests[:self.max_batch_size]
+                    self.buckets[bucket] = requests[self.max_batch_size:]
+                    if not self.buckets[bucket]:
+                        del self.buckets[bucket]
+                    return batch
+
+    def run(self):
+        while True:
+            requests = self.next_batch()
+            try:
+                summaries = self.summarise(requests)
+                for request, summary in zip(requests, summaries):
+                    request.future.set_result(summary)
+            except Exception as e:
+                for request in requests:
+                    request.future.set_exception(e)
+
+    def summarise(self, requests):
+        batch = self.tokenizer.pad({"input_ids": [r.input_ids for r in requests]}, return_tensors="pt")
+
+        with torch.no_grad(), self.precision.autocast():
+            graph_embeddings, num_nodes = self.graph_encoder.encode_graphs([r.graph_inputs for r in requests], self.device)
+            graph_enc_out, graph_mask = pad_graph_embeddings(graph_embeddings, num_nodes)
+            graph_enc_out = self.precision.cast_graph(graph_enc_out)
+
+            encoder_outputs = self.model.get_encoder()(
+                input_ids=batch["input_ids"].to(self.device),
+                attention_mask=batch["attention_mask"].to(self.device),
+                return_dict=True,
+            )
+            return decode_batch(self.model, self.tokenizer, batch, encoder_outputs, graph_enc_out, graph_mask, self.device)
+
+
+class SummarisationService():
+    """
+    Keeps the model, tokenizer and graph encoder loaded and turns requests into batcher inputs. A request is a JSON
+    object with either the `article` text and its `graph` (in the `*_graphs_with_features.pkl` format), or the `id`
+    (and `split`, default "test") of an article whose text and graph are looked up in the eLife data.
+    """
+    def __init__(self, args):
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+        self.config = load_train_config(args.model_dir)
+        self.tokenizer = AutoTokenizer.from_pretrained(args.model_dir)
+        self.precision = PrecisionPolicy.from_config(self.config, device)
+        self.model = load_model(args.model_dir, self.config, device, self.precision.model_dtype)
+        self.graph_encoder = GraphEncoder(self.config, graph_precision=self.precision.graph)
+        self.articles = {}
+
+        self.batcher = DynamicBatcher(
+            self.model, self.tokenizer, self.graph_encoder, device, self.precision, self.config['encoder_max_length'],
+            max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms, bucket_size=args.bucket_size,
+        )
+
+    def get_article(self, aid, split):
+        if split not in self.articles:
+            # model inputs as in training, including the graph text of input-augmented models
+            graph_text_path = self.config['graph_data_path'] if self.config.get('is_input_aug') else None
+            self.articles[split] = {inst['id']: inst['article'] for inst in iter_indexed_articles("elife", split, graph_text_path)}
+        return self.articles[split][aid]
+
+    def summarise(self, request):
+        if "id" in request:
+            split = request.get("split", "test")
+            store = self.graph_encoder.get_store(split)
+            graph_inputs = self.graph_encoder.get_graph_inputs(store.index(request["id"]), split)
+            article = request.get("article") or self.get_article(request["id"], split)
+        else:
+            graph_inputs = self.graph_encoder.get_graph_inputs_from_dict(request["graph"])
+            article = request["article"]
+
+        return self.batcher.submit(article, graph_inputs).result()
+
+
+def make_handler(service):
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != "/summarise":
+                self.send_error(404)
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                response, status = {"summary": service.summarise(request)}, 200
+            except (KeyError, ValueError) as e:
+                response, status = {"error": f"invalid request: {e}"}, 400
+            except Exception as e:
+                response, status = {"error": str(e)}, 500
+
+            body = json.dumps(response).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    service = SummarisationService(args)
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    print(f"Serving summaries on http://{args.host}:{args.port}/summarise")
+    server.serve_forever()
@@ -1,14 +1,16 @@
 
-import torch, sys
+import torch, os, sys
 from torch.optim import AdamW
-import nltk
-import evaluate
 from accelerate import Accelerator
+from accelerate.data_loader import prepare_data_loader
 import numpy as np
-from model import LEDKForConditionalGeneration, GraphEncoder
+from model import LEDKForConditionalGeneration, GraphEncoder, pop_graph_batch
 from tqdm import tqdm
 from transformers import AutoTokenizer, get_scheduler
-from utils import get_processed_elife_data, load_train_config, update_config
+from metrics import StepMetrics, MetricsWriter, make_profiler, split_graph_phase
+from precision import PrecisionPolicy
+from rouge_scoring import IncrementalRouge
+from utils import get_processed_elife_data, get_tokenized_elife_data, get_elife_dataloader, load_train_config, update_config
 # import wandb
 
 # run = wandb.init(
@@ -25,22 +27,40 @@ config = load_train_config(config_path)
 ds = "elife"
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 print('device: "%s"' % device)
-accelerator = Accelerator()
+# weights stay in float32 for training, autocast (if set) is applied by accelerate
+precision = PrecisionPolicy.from_config(config, device)
+print(precision)
+accelerator = Accelerator(mixed_precision=precision.mixed_precision)
 tokenizer = AutoTokenizer.from_pretrained(config['model_str'])
-metric = evaluate.load("rouge")
+# ROUGE is scored in background processes as validation batches are decoded
+metric = IncrementalRouge(num_workers=config.get('rouge_num_workers'))
 
-train_dataloader = get_processed_elife_data(ds, tokenizer, config, "train", shuffle=True)
-val_dataloader = get_processed_elife_data(ds, tokenizer, config, "val", shuffle=False) 
+# graph inputs are assembled by the DataLoader (in `num_workers` background processes, if set)
+graph_encoder = GraphEncoder(config, graph_precision=precision.graph)
+# batches are sharded between the processes by the batch sampler (see `LengthBucketBatchSampler`)
+train_dataloader = get_processed_elife_data(ds, tokenizer, config, "train", shuffle=True, graph_collate=graph_encoder.get_collate("train"),
+                                            num_processes=accelerator.num_processes, process_index=accelerator.process_index)
+train_batch_sampler = train_dataloader.batch_sampler
 
-def postprocess_text(preds, labels):
-    preds = [pred.strip() for pred in preds]
-    labels = [label.strip() for label in labels]
+# Validation: "beam" generates with the model's generation settings over the whole val split at the end of each epoch
+# (or only the epochs in `beam_epochs`), "subset_greedy" generates greedily for the first `subset_size` val articles
+# every `eval_steps` optimisation steps and at the end of each epoch, "loss" computes the val loss at the end of each epoch
+VALIDATION_MODES = ["beam", "subset_greedy", "loss"]
+validation_config = config.get('validation', {})
+validation_mode = validation_config.get('mode', "beam")
+if validation_mode not in VALIDATION_MODES:
+    raise ValueError(f"validation mode should be one of {VALIDATION_MODES}, got {validation_mode}")
+metric_for_best_model = validation_config.get('metric_for_best_model', "loss" if validation_mode == "loss" else "rougeLsum")
+eval_steps = validation_config.get('eval_steps', 1000)
+if validation_mode == "subset_greedy" and (not isinstance(eval_steps, int) or eval_steps < 1):
+    raise ValueError(f"validation eval_steps should be a positive integer, got {eval_steps}")
 
-    # rougeLSum expects newline after each sentence
-    preds = ["\n".join(nltk.sent_tokenize(pred)) for pred in preds]
-    labels = ["\n".join(nltk.sent_tokenize(label)) for label in labels]
-
-    return preds, labels
+val_data = get_tokenized_elife_data(ds, tokenizer, config, "val")
+if validation_mode == "subset_greedy":
+    # the same articles every time, so that evaluations are comparable
+    val_data = val_data.select(range(min(validation_config.get('subset_size', 64), len(val_data))))
+val_dataloader = get_elife_dataloader(val_data, tokenizer, config, shuffle=False, graph_collate=graph_encoder.get_collate("val"),
+                                      num_processes=accelerator.num_processes, process_index=accelerator.process_index)
 
 print("Loading model...")
 
@@ -50,8 +70,9 @@ model = LEDKForConditionalGeneration.from_pretrained(
     use_cache=False, 
     is_merge_encoders=config['is_merge_encoders'], 
     is_graph_decoder=config['is_graph_decoder'],
+    graph_attention_strategy=config.get('graph_attention_strategy', 'full'),
+    graph_attention_window=config.get('graph_attention_window', 512),
     )
-graph_encoder = GraphEncoder(config)
 
 # set generate hyperparameters
 model.config.num_beams = config['num_beams']
@@ -62,11 +83,17 @@ model.config.no_repeat_ngram_size = config['no_repeat_ngram_size']
 
 optimizer = AdamW(model.parameters(), lr=config['lr'])
 
-train_dataloader, val_dataloader, model, optimizer = accelerator.prepare(
-    train_dataloader, val_dataloader, model, optimizer
-)
+model, optimizer = accelerator.prepare(model, optimizer)
+# the dataloaders are already sharded, so they are only set to place batches on the device (as accelerate does on a
+# single process), not sharded again
+train_dataloader, val_dataloader = [
+    prepare_data_loader(dataloader, accelerator.device, num_processes=1, process_index=0, put_on_device=True)
+    for dataloader in [train_dataloader, val_dataloader]
+]
 
-num_training_steps = config['num_epochs'] * len(train_dataloader)
+# with a token budget per batch, the number of batches differs between epochs, so the schedule is computed from the
+# batches of this process in every epoch
+num_training_steps = sum(train_batch_sampler.epoch_lengths(config['num_epochs']))
 lr_scheduler = get_scheduler(
   "linear",
   optimizer=optimizer,
@@ -76,108 +103,194 @@ lr_scheduler = get_scheduler(
 
 progress_bar = tqdm(range(num_training_steps))
 
-epoch_measures = []
+# per-step phase timings and throughput, written to a JSONL file, and an optional profiler trace of `profile_steps`
+os.makedirs(config['output_dir'], exist_ok=True)
+metrics = StepMetrics(device, sync=config.get('metrics_sync', True))
+metrics.add_hooks(graph_encoder.GM, "gat_forward")
+metrics.add_hooks(accelerator.unwrap_model(model).get_encoder(), "led_encoder")
+metrics.add_hooks(accelerator.unwrap_model(model).get_decoder(), "led_decoder")
+metrics_writer = MetricsWriter(
+    config.get('metrics_path', f"{config['output_dir']}/train_metrics.jsonl") if accelerator.is_main_process else None
+)
+profiler = make_profiler(config.get('profile_steps'), f"{config['output_dir']}/profile")
 
-print("Training...")
 
-completed_steps = 0
+def write_metrics(**fields):
+    record = metrics.record(**fields)
+    metrics_writer.write(split_graph_phase(record))
 
-# Manual train loop
-for epoch in range(config['num_epochs']):
-    model.train()
-    for step, batch in enumerate(train_dataloader):
 
-        with accelerator.accumulate(model):
-            # get graphs
-            aids = batch["idx"]
-            graph_enc_out = []
-            for i, aid in enumerate(aids):
-                graph_out = graph_encoder.forward(aid, "train", device)
-                graph_out = torch.nn.functional.pad(graph_out, (0,0,0,config['GAT_embedding_size']-graph_out.shape[0]), "constant", 0)
-                graph_enc_out.append(graph_out)
-            graph_enc_out = torch.stack(graph_enc_out, dim=1).to(torch.float16)
-            graph_enc_out = graph_enc_out.view(len(aids), -1, config['GAT_embedding_size'])
-            del batch['idx']
-            batch['graph_encoder_outputs'] = graph_enc_out
-            
-            # get model outputs
-            outputs = model(**batch)
-            loss = outputs.loss
-            # wandb.log({"loss": loss, "step": step})
-            accelerator.backward(loss)
-            optimizer.step()
-            lr_scheduler.step()
-            optimizer.zero_grad()
-            
-            # Check if the accelerator has performed an optimization step behind the scenes
-            if accelerator.sync_gradients:
-                progress_bar.update(1)
-                completed_steps += 1
+def prepare_graph_inputs(batch):
+    # get graphs
+    with metrics.phase("graph"):
+        graph_batch = pop_graph_batch(batch)
+        metrics.count("graph_nodes", graph_batch["graph_num_nodes"].sum())
+        graph_enc_out, graph_mask = graph_encoder.forward_collated(graph_batch, device)
+    graph_enc_out = precision.cast_graph(graph_enc_out)
+    del batch['idx']
+    batch['graph_encoder_outputs'] = graph_enc_out
+    batch['graph_attention_mask'] = graph_mask
+    return batch
 
-    # Eval loop
-    model.eval()
-    for step, batch in enumerate(val_dataloader):
+
+def gather_articles(idxs, *tensors):
+    """
+    Gather per-article tensors from every process, keeping one row per article. Batches can differ in size between
+    processes, and the batches completing the last round of each process repeat articles (see `LengthBucketBatchSampler`).
+    Returns the article indices and the gathered tensors.
+    """
+    idxs = accelerator.pad_across_processes(idxs, dim=0, pad_index=-1)
+    tensors = [accelerator.pad_across_processes(tensor, dim=0) for tensor in tensors]
+    idxs, *tensors = accelerator.gather((idxs, *tensors))
+    idxs, first = np.unique(idxs.cpu().numpy(), return_index=True)
+    keep = torch.from_numpy(first[idxs != -1]).to(tensors[0].device)
+    return idxs[idxs != -1].tolist(), [tensor[keep] for tensor in tensors]
+
+
+def validate_loss(dataloader):
+    """
+    Mean loss over a validation set, without generation.
+    """
+    losses = {}
+    for batch in dataloader:
         with torch.no_grad():
-            aids = batch["idx"]
-           
-            graph_enc_out = []
-            for i, aid in enumerate(aids):
-                graph_out = graph_encoder.forward(aid, "val", device)
-                graph_out = torch.nn.functional.pad(graph_out, (0,0,0,1024-graph_out.shape[0]), "constant", 0)
-                graph_enc_out.append(graph_out)
-            graph_enc_out = torch.stack(graph_enc_out, dim=1).to(torch.float16)
-            graph_enc_out = graph_enc_out.view(len(aids), -1, 1024)
-            
-            del batch['idx']
-            
-            generated_tokens = accelerator.unwrap_model(model).generate(
-               batch["input_ids"],
-               attention_mask=batch["attention_mask"],
-               graph_encoder_outputs=graph_enc_out,   
-            ) 
+            idxs = batch["idx"]
+            batch = prepare_graph_inputs(batch)
+            loss = model(**batch).loss
+            idxs, (article_losses,) = gather_articles(idxs, loss.repeat(batch["input_ids"].size(0)))
+            losses.update(zip(idxs, article_losses.tolist()))
+    return {"loss": round(float(np.mean(list(losses.values()))), 4)}
 
-            generated_tokens = accelerator.pad_across_processes(
-               generated_tokens, dim=1, pad_index=tokenizer.pad_token_id
-            )
-            labels = batch["labels"]
-                
-            generated_tokens, labels = accelerator.gather_for_metrics((generated_tokens, labels))
-            generated_tokens = generated_tokens.cpu().numpy()
-            labels = labels.cpu().numpy()
-            labels = np.where(labels != -100, labels, tokenizer.pad_token_id)
 
-            generated_tokens = model.generate(
-                batch["input_ids"],
-                attention_mask=batch["attention_mask"],
-                graph_encoder_outputs=graph_enc_out, 
-            )
-            labels = batch["labels"]
+def validate_rouge(dataloader, **generate_kwargs):
+    """
+    ROUGE of summaries generated for a validation set, with a single generation pass per batch.
+    """
+    for batch in dataloader:
+        with torch.no_grad():
+            idxs = batch["idx"]
+            batch = prepare_graph_inputs(batch)
 
+            with metrics.phase("generation"):
+                generated_tokens = accelerator.unwrap_model(model).generate(
+                   batch["input_ids"],
+                   attention_mask=batch["attention_mask"],
+                   graph_encoder_outputs=batch['graph_encoder_outputs'],
+                   graph_attention_mask=batch['graph_attention_mask'],
+                   **generate_kwargs,
+                )
             if isinstance(generated_tokens, tuple):
                 generated_tokens = generated_tokens[0]
+            metrics.count("generated_tokens", (generated_tokens != tokenizer.pad_token_id).sum())
+
+            generated_tokens = accelerator.pad_across_processes(
+               generated_tokens, dim=1, pad_index=tokenizer.pad_token_id
+            )
+            labels = accelerator.pad_across_processes(batch["labels"], dim=1, pad_index=-100)
 
+            idxs, (generated_tokens, labels) = gather_articles(idxs, generated_tokens, labels)
             generated_tokens = generated_tokens.cpu().numpy()
             labels = labels.cpu().numpy()
             labels = np.where(labels != -100, labels, tokenizer.pad_token_id)
             decoded_preds = np.where(generated_tokens != -100, generated_tokens, tokenizer.pad_token_id)
-            
-            decoded_preds = tokenizer.batch_decode(decoded_preds, skip_special_tokens=True, clean_up_tokenization_spaces=True)
-            decoded_labels = tokenizer.batch_decode(labels, skip_special_tokens=True, clean_up_tokenization_spaces=True)
 
-            decoded_preds, decoded_labels = postprocess_text(decoded_preds, decoded_labels)
+            with metrics.phase("decode"):
+                decoded_preds = tokenizer.batch_decode(decoded_preds, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+                decoded_labels = tokenizer.batch_decode(labels, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+
+            with metrics.phase("rouge"):
+                # keyed by article, so that articles repeated between processes are scored once
+                metric.add(decoded_preds, decoded_labels, keys=idxs)
+
+    with metrics.phase("rouge"):
+        return metric.compute()
+
+
+def validate(name):
+    model.eval()
+    metrics.reset()
+    if validation_mode == "loss":
+        result = validate_loss(val_dataloader)
+    elif validation_mode == "subset_greedy":
+        result = validate_rouge(val_dataloader, num_beams=1)
+    else:
+        result = validate_rouge(val_dataloader)
+    write_metrics(validation=name, mode=validation_mode, **result)
+    model.train()
+    return result
+
+
+def is_better(result, best_result):
+    if best_result is None:
+        return True
+    # loss is minimised, ROUGE maximised
+    if metric_for_best_model == "loss":
+        return result[metric_for_best_model] < best_result[metric_for_best_model]
+    return result[metric_for_best_model] > best_result[metric_for_best_model]
+
+
+def save_if_best(result, name):
+    global best_result
+    print(name, result)
+    validation_measures.append({"checkpoint": name, **result})
+    if is_better(result, best_result):
+        best_result = result
+        accelerator.unwrap_model(model).save_pretrained(f"{config['output_dir']}/{ds}_{name}")
+        tokenizer.save_pretrained(f"{config['output_dir']}/{ds}_{name}")
+
+        update_config(config, f"{config['output_dir']}/{ds}_{name}")
+
+
+validation_measures = []
+best_result = None
+
+print("Training...")
+
+completed_steps = 0
+
+# Manual train loop
+for epoch in range(config['num_epochs']):
+    model.train()
+    metrics.reset()
+    for step, batch in enumerate(train_dataloader):
+        metrics.since_start("data")
+
+        with accelerator.accumulate(model):
+            batch = prepare_graph_inputs(batch)
+            metrics.count("tokens", batch["attention_mask"].sum() + (batch["labels"] != -100).sum())
             
-            metric.add_batch(
-                predictions=decoded_preds,
-                references=decoded_labels,
-            )
+            # get model outputs
+            with metrics.phase("forward"):
+                outputs = model(**batch)
+            loss = outputs.loss
+            # wandb.log({"loss": loss, "step": step})
+            with metrics.phase("backward"):
+                accelerator.backward(loss)
+            with metrics.phase("optimizer"):
+                optimizer.step()
+                lr_scheduler.step()
+                optimizer.zero_grad()
 
-    result = metric.compute(use_stemmer=True)
-    result = {k: round(v * 100, 4) for k, v in result.items()}
-    epoch_measures.append(result)
-   
-    if result > max(epoch_measures):
-        model.save_pretrained(f"{config['output_dir']}/{ds}_epoch_{epoch}")
-        tokenizer.save_pretrained(f"{config['output_dir']}/{ds}_epoch_{epoch}")
+        write_metrics(epoch=epoch, step=step, loss=round(loss.item(), 4))
+        if profiler is not None:
+            profiler.step()
+
+        # Check if the accelerator has performed an optimization step behind the scenes
+        if accelerator.sync_gradients:
+            progress_bar.update(1)
+            completed_steps += 1
+
+            if validation_mode == "subset_greedy" and completed_steps % eval_steps == 0:
+                save_if_best(validate(f"step_{completed_steps}"), f"step_{completed_steps}")
+                metrics.reset()
+
+    # Eval loop
+    if validation_mode == "beam" and validation_config.get('beam_epochs') is not None \
+            and epoch not in validation_config['beam_epochs']:
+        continue
+    save_if_best(validate(f"epoch_{epoch}"), f"epoch_{epoch}")
 
-        update_config(config)
-                
+metric.close()
+metrics_writer.close()
+if profiler is not None:
+    profiler.stop()
@@ -1,126 +1,415 @@
 
+import os
 import json
+import random
+import shutil
+import hashlib
+from functools import partial
+import torch
 from torch.utils.data.dataloader import DataLoader
 from datasets import Dataset
 from torch.utils.data.dataloader import DataLoader
 
 
+# directory holding the `{ds}/{split}.json` files of each dataset
+DATA_ROOT = os.environ.get("DATA_ROOT", "/home/dock")
+
+
 def load_train_config(config_path="train_config.json"):
     """
-    Load config for training.
+    Load config for training. For a trained model directory, the config saved with the model (see `update_config`)
+    is read on top of the default `train_config.json`.
     """
-    with open("train_config.json", "r") as f:
+    if os.path.isdir(config_path):
+        config = load_train_config()
+        with open(f"{config_path}/config.json", "r") as f:
+            config.update(json.loads(f.read()))
+        return config
+
+    with open(config_path, "r") as f:
         config = json.loads(f.read())
     return config
 
-def load_dataset(ds, split):
-    fp = f"/home/dock/{ds}/{split}.json"
+def get_data_path(ds, split):
+    return f"{DATA_ROOT}/{ds}/{split}.json"
+
+def get_jsonl_data_path(ds, split):
+    return f"{DATA_ROOT}/{ds}/{split}.jsonl"
+
+def get_source_path(ds, split):
+    # the line-delimited version of a split is read instead of the original file if it exists
+    jsonl_path = get_jsonl_data_path(ds, split)
+    return jsonl_path if os.path.exists(jsonl_path) else get_data_path(ds, split)
+
+def get_graph_text_path(graph_text_path, split):
+    return f"{graph_text_path}/{split}_abstract_concepts_explanation.jsonl"
+
+
+def iter_json_array(fp, chunk_size=1 << 20):
+    """
+    Stream the elements of a JSON array file one at a time, without reading the whole file into memory.
+    """
+    decoder = json.JSONDecoder()
     with open(fp, "r") as f:
-        data = json.loads(f.read())
+        buffer = f.read(chunk_size).lstrip()
+        if not buffer.startswith("["):
+            raise ValueError(f"{fp} does not contain a JSON array")
+        buffer = buffer[1:]
 
-    data = [dict(id=inst['id'], 
-            article=" ".join(inst['abstract'])+"\n"+"\n".join([" ".join(s) for s in inst['sections']]), 
-            summary=" ".join(inst['summary'])) for inst in data]
-    return data        
+        while True:
+            buffer = buffer.lstrip()
+            if buffer.startswith(","):
+                buffer = buffer[1:].lstrip()
+            if buffer.startswith("]"):
+                return
 
+            try:
+                inst, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                # element not fully read yet
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    raise
+                buffer += chunk
+                continue
 
-def load_dataset_abstract(ds, split):
-    fp = f"/home/dock/{ds}/{split}.json"
+            yield inst
+            buffer = buffer[end:]
+
+
+def convert_to_jsonl(ds, split):
+    """
+    Write the line-delimited version of a split, read by `iter_articles`. Sections are stored as a JSON string,
+    so that they are only decoded when the full article text is needed.
+    """
+    out_path = get_jsonl_data_path(ds, split)
+    with open(out_path + ".tmp", "w") as out_f:
+        for inst in iter_json_array(get_data_path(ds, split)):
+            line = dict(id=inst['id'], abstract=inst['abstract'], summary=inst['summary'], sections=json.dumps(inst['sections']))
+            out_f.write(json.dumps(line))
+            out_f.write("\n")
+    os.replace(out_path + ".tmp", out_path)
+
+
+def iter_articles(ds, split, columns=("id", "article", "summary"), abstract_only=False):
+    """
+    Stream the articles of a split one at a time, as dicts holding the requested `columns`.
+    The article text is built from the abstract only if `abstract_only`, in which case sections are never joined.
+    """
+    fp = get_source_path(ds, split)
     with open(fp, "r") as f:
-        data = json.loads(f.read())
+        insts = (json.loads(line) for line in f) if fp.endswith(".jsonl") else iter_json_array(fp)
+
+        for inst in insts:
+            out = {}
+            if "id" in columns:
+                out['id'] = inst['id']
+            if "article" in columns:
+                out['article'] = " ".join(inst['abstract'])
+                if not abstract_only:
+                    sections = json.loads(inst['sections']) if isinstance(inst['sections'], str) else inst['sections']
+                    out['article'] += "\n"+"\n".join([" ".join(s) for s in sections])
+            if "summary" in columns:
+                out['summary'] = " ".join(inst['summary'])
+            yield out
+
+
+def load_dataset(ds, split):
+    return list(iter_articles(ds, split))
 
-    data = [dict(id=inst['id'],
-            article=" ".join(inst['abstract']), 
-            summary=" ".join(inst['summary'])) for inst in data]
-    return data
+
+def load_dataset_abstract(ds, split):
+    return list(iter_articles(ds, split, abstract_only=True))
 
 
 def add_graph_text_data(graph_text_path, split, data):
     """
-    Load augmented text data for the given dataset and split.
+    Add augmented text data for the given dataset and split to a stream of articles.
+    Graph texts are matched to the articles by id; an article without one, or a graph text without its article,
+    raises a ValueError.
     """
-    fp = f"{graph_text_path}/{split}_abstract_concepts_explanation.jsonl"
+    fp = get_graph_text_path(graph_text_path, split)
+    graph_texts = {}
     with open(fp, "r") as f:
-        explain_data = f.readlines()
-        explain_data = [json.loads(line) for line in explain_data]
+        for line in f:
+            graph_explainations = json.loads(line)
+            graph_texts[graph_explainations['id']] = graph_explainations['text']
 
-    for i, inst in enumerate(data):
-        aid = inst['id']
-        graph_explainations = explain_data[i]
-        assert aid == graph_explainations['id']
-        data[i]['article'] = "[GRAPH_FACTS]\n" + graph_explainations['text'] + "\n[ARTICLE]\n" + data[i]['article'] 
+    for inst in data:
+        if inst['id'] not in graph_texts:
+            raise ValueError(f"No graph text for article {inst['id']} of split {split} in {fp}")
+        inst['article'] = "[GRAPH_FACTS]\n" + graph_texts.pop(inst['id']) + "\n[ARTICLE]\n" + inst['article']
+        yield inst
+
+    if graph_texts:
+        raise ValueError(f"{len(graph_texts)} graph texts in {fp} have no article in split {split}, e.g. {next(iter(graph_texts))}")
+
+
+def iter_indexed_articles(ds, split, graph_text_path=None):
+    data = ({"idx": i, **x} for i, x in enumerate(iter_articles(ds, split)))
+
+    if graph_text_path is not None:
+        data = add_graph_text_data(graph_text_path, split, data)
+
+    yield from data
 
-    return data
     
-def update_config(kg_config):
-    with open(f"{kg_config['output_dir']}/config.json", "r") as f:
+def update_config(kg_config, model_dir):
+    """
+    Add the training config to the config of a saved model, so that it is loaded along with the model.
+    """
+    with open(f"{model_dir}/config.json", "r") as f:
         config = json.loads(f.read())
     
     config.update(kg_config)
 
-    with open(f"{kg_config['output_dir']}/config.json", "w") as f:
+    with open(f"{model_dir}/config.json", "w") as f:
         f.write(json.dumps(config, indent=2))
  
-def get_processed_elife_data(ds, tokenizer, config, split, shuffle=False):
+class LengthBucketBatchSampler():
+    """
+    Batch sampler grouping articles of similar length. Batches either hold `batch_size` articles or, if `max_tokens`
+    is given, as many articles as fit in `max_tokens` padded input tokens. When shuffling, articles are shuffled,
+    sorted by length within buckets of `bucket_size_multiplier` batches, and the resulting batches shuffled again;
+    otherwise the original order is kept. The order of each epoch is drawn from `seed` and the epoch number, so that
+    every process draws the same batches.
+    With several processes, the batches are sharded here rather than by accelerate (whose sharding assumes batches of
+    `batch_size` articles): each of the `num_processes` processes iterates every `num_processes`-th batch, starting at
+    `process_index`, and the last ones are completed with batches from the start so that all iterate the same number.
+    """
+    def __init__(self, lengths, batch_size, max_tokens=None, shuffle=False, bucket_size_multiplier=50, pad_to_multiple_of=1,
+                 seed=0, num_processes=1, process_index=0):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.bucket_size_multiplier = bucket_size_multiplier
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.seed = seed
+        self.num_processes = num_processes
+        self.process_index = process_index
+        self.epoch = 0
+        self.batches = self.make_batches(self.epoch)
+
+    def padded_length(self, length):
+        return -(-length // self.pad_to_multiple_of) * self.pad_to_multiple_of
+
+    def split_batches(self, indices):
+        batches, batch, batch_len = [], [], 0
+        for i in indices:
+            new_len = max(batch_len, self.padded_length(self.lengths[i]))
+            if self.max_tokens is not None:
+                is_full = batch and new_len * (len(batch) + 1) > self.max_tokens
+            else:
+                is_full = len(batch) == self.batch_size
+            if is_full:
+                batches.append(batch)
+                batch, new_len = [], self.padded_length(self.lengths[i])
+            batch.append(i)
+            batch_len = new_len
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def shard_batches(self, batches):
+        if self.num_processes == 1:
+            return batches
+        # processes stay in step only if they all iterate the same number of batches
+        num_missing = -len(batches) % self.num_processes
+        batches = batches + [batches[i % len(batches)] for i in range(num_missing)]
+        return batches[self.process_index::self.num_processes]
+
+    def make_batches(self, epoch):
+        """
+        Batches of this process for an epoch.
+        """
+        indices = list(range(len(self.lengths)))
+        if not self.shuffle:
+            return self.shard_batches(self.split_batches(indices))
+
+        rng = random.Random(self.seed + epoch)
+        rng.shuffle(indices)
+        bucket_size = self.batch_size * self.bucket_size_multiplier
+        batches = []
+        for start in range(0, len(indices), bucket_size):
+            bucket = sorted(indices[start:start+bucket_size], key=lambda i: self.lengths[i])
+            batches.extend(self.split_batches(bucket))
+        rng.shuffle(batches)
+        return self.shard_batches(batches)
+
+    def epoch_lengths(self, num_epochs):
+        """
+        Number of batches of this process in each of the first `num_epochs` epochs (which can differ between epochs
+        with `max_tokens`).
+        """
+        return [len(self.make_batches(epoch)) for epoch in range(num_epochs)]
+
+    def __iter__(self):
+        yield from self.batches
+        self.epoch += 1
+        self.batches = self.make_batches(self.epoch)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def collate_elife_batch(features, pad_token_id, pad_to_multiple_of=1, graph_collate=None):
+    """
+    Pad a list of tokenized articles to the longest one in the batch, rounded up to `pad_to_multiple_of`.
+    If given, `graph_collate` is called with the article indices and the graph inputs it returns are added to the batch.
+    """
+    max_len = max(len(f["input_ids"]) for f in features)
+    max_len = -(-max_len // pad_to_multiple_of) * pad_to_multiple_of
+    max_label_len = max(len(f["labels"]) for f in features)
+
+    batch = {
+        "input_ids": torch.full((len(features), max_len), pad_token_id, dtype=torch.long),
+        "attention_mask": torch.zeros((len(features), max_len), dtype=torch.long),
+        "global_attention_mask": torch.zeros((len(features), max_len), dtype=torch.long),
+        # We have to make sure that the PAD token is ignored
+        "labels": torch.full((len(features), max_label_len), -100, dtype=torch.long),
+        "idx": torch.tensor([f["idx"] for f in features]),
+    }
+    for i, f in enumerate(features):
+        batch["input_ids"][i, :len(f["input_ids"])] = torch.tensor(f["input_ids"])
+        batch["attention_mask"][i, :len(f["input_ids"])] = 1
+        batch["labels"][i, :len(f["labels"])] = torch.tensor(f["labels"])
+
+    # global attention on the first token
+    batch["global_attention_mask"][:, 0] = 1
+
+    if graph_collate is not None:
+        batch.update(graph_collate(batch["idx"]))
+
+    return batch
+
+
+def hash_file(fp):
+    h = hashlib.sha1()
+    with open(fp, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def get_tokenized_cache_path(ds, tokenizer, config, split):
+    """
+    Location of the tokenized split in the cache, keyed by the tokenizer, tokenization settings and source files.
+    """
+    source_files = [get_source_path(ds, split)]
+    if config['is_input_aug']:
+        source_files.append(get_graph_text_path(config['graph_data_path'], split))
+
+    key = {
+        "tokenizer": tokenizer.name_or_path,
+        "tokenizer_class": type(tokenizer).__name__,
+        "vocab_size": len(tokenizer),
+        "encoder_max_length": config['encoder_max_length'],
+        "decoder_max_length": config['decoder_max_length'],
+        "is_input_aug": config['is_input_aug'],
+        "source_files": [hash_file(fp) for fp in source_files],
+    }
+    key = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+
+    return f"{config.get('tokenized_cache_dir', './cache/tokenized')}/{ds}_{split}_{key}"
+
+
+def get_tokenized_elife_data(ds, tokenizer, config, split):
     
     def process_data_to_model_inputs(batch):
-        # tokenize the inputs and labels
+        # tokenize the inputs and labels (padding is done per batch, see collate_elife_batch)
         inputs = tokenizer(
             batch["article"],
-            padding="max_length",
             truncation=True,
             max_length=config['encoder_max_length'],
         )
         outputs = tokenizer(
             batch["summary"],
-            padding="max_length",
             truncation=True,
             max_length=config['decoder_max_length'],
         )
 
         batch["input_ids"] = inputs.input_ids
-        batch["attention_mask"] = inputs.attention_mask
+        batch["labels"] = outputs.input_ids
+        batch["length"] = [len(x) for x in inputs.input_ids]
 
-        # create 0 global_attention_mask lists
-        batch["global_attention_mask"] = len(batch["input_ids"]) * [
-            [0 for _ in range(len(batch["input_ids"][0]))]
-        ]
+        return batch
 
-        # since above lists are references, the following line changes the 0 index for all samples
-        batch["global_attention_mask"][0][0] = 1
-        batch["labels"] = outputs.input_ids
+    # tokenized splits are cached on disk (Arrow, memory-mapped when loaded)
+    cache_path = get_tokenized_cache_path(ds, tokenizer, config, split)
 
-        # We have to make sure that the PAD token is ignored
-        batch["labels"] = [
-            [-100 if token == tokenizer.pad_token_id else token for token in labels]
-            for labels in batch["labels"]
-        ]
+    if not os.path.exists(cache_path):
+        # articles are streamed from the source file rather than held in memory
+        data = Dataset.from_generator(
+            iter_indexed_articles,
+            gen_kwargs={
+                "ds": ds, "split": split,
+                "graph_text_path": config['graph_data_path'] if config['is_input_aug'] else None,
+            },
+            cache_dir=cache_path + ".tmp",
+        )
 
-        return batch
+        # map train data
+        data = data.map(
+            process_data_to_model_inputs,
+            batched=True,
+            batch_size=config['batch_size'],
+            remove_columns=["article", "summary"],
+            num_proc=config.get('tokenize_num_proc', os.cpu_count()),
+        )
+        # saved next to the cache and moved into place once complete, so that an interrupted run leaves no partial cache
+        partial_path = f"{cache_path}.partial{os.getpid()}"
+        data.save_to_disk(partial_path)
+        try:
+            os.replace(partial_path, cache_path)
+        except OSError:
+            # another process has completed the same cache in the meantime
+            if not os.path.exists(cache_path):
+                raise
+            shutil.rmtree(partial_path, ignore_errors=True)
+        shutil.rmtree(cache_path + ".tmp", ignore_errors=True)
 
-    data = load_dataset(ds, split)
+    data = Dataset.load_from_disk(cache_path)
 
-    data = [{"idx": i, **x} for i, x in enumerate(data)]
+    return data
 
-    if config['is_input_aug']:
-        data = add_graph_text_data(config['graph_data_path'], "train", data)
 
-    data = Dataset.from_list(data)
+def get_elife_dataloader(data, tokenizer, config, shuffle=False, graph_collate=None, num_processes=1, process_index=0):
+
+    lengths = data["length"]
+    data.set_format(columns=["input_ids", "labels", "idx"])
 
-    # map train data
-    data = data.map(
-        process_data_to_model_inputs,
-        batched=True,
-        batch_size=config['batch_size'],
+    # pad to multiples of LED's attention window
+    pad_to_multiple_of = config.get('pad_to_multiple_of', 1024)
+    batch_sampler = LengthBucketBatchSampler(
+        lengths,
+        config['batch_size'],
+        max_tokens=config.get('max_tokens_per_batch'),
+        shuffle=shuffle,
+        bucket_size_multiplier=config.get('bucket_size_multiplier', 50),
+        pad_to_multiple_of=pad_to_multiple_of,
+        seed=config.get('seed', 0),
+        num_processes=num_processes,
+        process_index=process_index,
     )
 
-    # set Python list to PyTorch tensor
-    data.set_format(
-        type="torch",
-        columns=["input_ids", "attention_mask", "global_attention_mask", "labels", "idx"],
+    # batches (and their graph inputs) are assembled in background worker processes if `num_workers` is set
+    num_workers = config.get('num_workers', 0)
+    dataloader = DataLoader(
+        data,
+        batch_sampler=batch_sampler,
+        collate_fn=partial(collate_elife_batch, pad_token_id=tokenizer.pad_token_id, pad_to_multiple_of=pad_to_multiple_of,
+                           graph_collate=graph_collate),
+        num_workers=num_workers,
+        pin_memory=config.get('pin_memory', False),
+        prefetch_factor=config.get('prefetch_factor', 2) if num_workers > 0 else None,
+        persistent_workers=num_workers > 0,
     )
 
+    return dataloader
 
-    dataloader = DataLoader(data, batch_size=config['batch_size'], shuffle=shuffle)
 
-    return dataloader
+def get_processed_elife_data(ds, tokenizer, config, split, shuffle=False, graph_collate=None, num_processes=1, process_index=0):
+    data = get_tokenized_elife_data(ds, tokenizer, config, split)
+    return get_elife_dataloader(data, tokenizer, config, shuffle=shuffle, graph_collate=graph_collate,
+                                num_processes=num_processes, process_index=process_index)